@@ -0,0 +1,186 @@
+"""
+倒排索引（CSR：term → postings）上的 BM25Okapi，
+打分只触及查询词的 postings，top-k 用部分选择；分数与 rank_bm25.BM25Okapi 逐位一致
+"""
+import json, math
+import numpy as np
+from pathlib import Path
+from collections import Counter
+from typing import List, Optional, Sequence, Tuple
+from .cache import atomic_dir
+
+
+
+class SparseBM25():
+    def __init__(self, corpus_tokens: Sequence[Sequence[str]],
+                 k1: float = 1.5, b: float = 0.75, epsilon: float = 0.25):
+        self.k1, self.b, self.epsilon = k1, b, epsilon
+        vocab = {}                       # term → term_id，按首次出现顺序编号（与 rank_bm25 的 nd 顺序一致）
+        term_ids, doc_ids, tfs, doc_len = [], [], [], []
+        for d, tokens in enumerate(corpus_tokens):
+            doc_len.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                term_ids.append(vocab.setdefault(term, len(vocab)))
+                doc_ids.append(d)
+                tfs.append(tf)
+
+        self.vocab     = vocab
+        self.n_docs    = len(doc_len)
+        self.doc_len   = np.asarray(doc_len, dtype=np.int64)
+        self.avgdl     = int(self.doc_len.sum()) / self.n_docs
+
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        order    = np.argsort(term_ids, kind="stable")          # 同一 term 内 doc 升序
+        self.doc_ids = np.asarray(doc_ids, dtype=np.int64)[order]
+        tf_sorted    = np.asarray(tfs, dtype=np.int64)[order]
+        self.indptr  = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_ids, minlength=len(vocab)), out=self.indptr[1:])
+
+        self.idf = self._calc_idf(np.diff(self.indptr))
+        self.weights = self._calc_weights(tf_sorted)
+
+
+    def _calc_idf(self, df: np.ndarray) -> np.ndarray:
+        # 与 BM25Okapi._calc_idf 相同的计算与累加顺序
+        idf, idf_sum, negative = np.zeros(len(df)), 0.0, []
+        for t, freq in enumerate(df.tolist()):
+            v = math.log(self.n_docs - freq + 0.5) - math.log(freq + 0.5)
+            idf[t] = v
+            idf_sum += v
+            if v < 0:
+                negative.append(t)
+        self.average_idf = idf_sum / len(df) if len(df) else 0.0
+        idf[negative] = self.epsilon * self.average_idf
+        return idf
+
+
+    def _calc_weights(self, tf: np.ndarray) -> np.ndarray:
+        """每个 posting 的 idf · tf(k1+1) / (tf + k1(1-b+b·dl/avgdl))，表达式顺序同 BM25Okapi.get_scores"""
+        dl   = self.doc_len[self.doc_ids]
+        term = np.repeat(np.arange(len(self.vocab)), np.diff(self.indptr))
+        return self.idf[term] * (tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * dl / self.avgdl)))
+
+
+    # ---------- 持久化 ----------
+    _ARRAYS = ("indptr", "doc_ids", "weights", "doc_len", "idf")
+
+    def save(self, path, fingerprint: str = "") -> None:
+        """
+        写出 vocab / postings / 文档长度 / idf 等；meta.json 最后写入。
+        整个目录先写到临时目录再换入 path：仍 mmap 着旧数组的实例不受影响，
+        中途崩溃时 path 保持旧版本
+        """
+        with atomic_dir(path) as tmp:
+            for name in self._ARRAYS:
+                np.save(tmp / f"{name}.npy", getattr(self, name))
+            with open(tmp / "vocab.json", "w", encoding="utf-8") as f:
+                json.dump(list(self.vocab), f, ensure_ascii=False)
+            with open(tmp / "meta.json", "w", encoding="utf-8") as f:
+                json.dump({"fingerprint": fingerprint, "n_docs": self.n_docs, "avgdl": self.avgdl,
+                           "average_idf": self.average_idf,
+                           "k1": self.k1, "b": self.b, "epsilon": self.epsilon}, f)
+
+
+    @classmethod
+    def load(cls, path, fingerprint: str = None, mmap: bool = True):
+        """
+        读取 save 的结果（数组以 mmap 打开）；指纹不匹配或文件不完整时返回 None
+        """
+        path = Path(path)
+        if not (path / "meta.json").exists():
+            return None
+        with open(path / "meta.json", encoding="utf-8") as f:
+            meta = json.load(f)
+        if fingerprint is not None and meta["fingerprint"] != fingerprint:
+            return None
+
+        obj = cls.__new__(cls)
+        obj.k1, obj.b, obj.epsilon = meta["k1"], meta["b"], meta["epsilon"]
+        obj.n_docs, obj.avgdl, obj.average_idf = meta["n_docs"], meta["avgdl"], meta["average_idf"]
+        for name in cls._ARRAYS:
+            setattr(obj, name, np.load(path / f"{name}.npy", mmap_mode="r" if mmap else None))
+        with open(path / "vocab.json", encoding="utf-8") as f:
+            obj.vocab = {t: i for i, t in enumerate(json.load(f))}
+        return obj
+
+
+    # ---------- 打分 ----------
+    def _postings(self, query_tokens: Sequence[str]):
+        """按查询词顺序（含重复词）拼接 postings"""
+        spans = [(self.indptr[t], self.indptr[t + 1])
+                 for t in (self.vocab.get(q) for q in query_tokens) if t is not None]
+        if not spans:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        docs = np.concatenate([self.doc_ids[s:e] for s, e in spans])
+        wts  = np.concatenate([self.weights[s:e] for s, e in spans])
+        return docs, wts
+
+
+    def score_candidates(self, query_tokens: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """只对含查询词的文档打分，返回 (doc_ids 升序, scores)；其余文档得分为 0"""
+        docs, wts = self._postings(query_tokens)
+        cand, inverse = np.unique(docs, return_inverse=True)
+        scores = np.zeros(len(cand))
+        np.add.at(scores, inverse, wts)          # 逐条顺序累加，与逐词 score += … 的浮点结果一致
+        return cand, scores
+
+
+    def get_scores(self, query_tokens: Sequence[str]) -> np.ndarray:
+        """与 BM25Okapi.get_scores 相同的稠密分数向量（主要用于校验）"""
+        scores = np.zeros(self.n_docs)
+        cand, s = self.score_candidates(query_tokens)
+        scores[cand] = s
+        return scores
+
+
+    def top_k(self, query_tokens: Sequence[str], k: int,
+              mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        返回 (doc_ids, scores)，顺序等价于
+            sorted(range(N), key=lambda i: scores[i], reverse=True)[:k]
+        即分数降序、同分按下标升序；mask 为 bool 数组时只在 mask 为 True 的文档中选
+        """
+        cand, s = self.score_candidates(query_tokens)
+        return self._select(cand, s, k, mask)
+
+
+    def top_k_batch(self, queries_tokens: Sequence[Sequence[str]], k: int,
+                    mask: Optional[np.ndarray] = None) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        逐查询等价于 top_k(tokens, k, mask)。
+        打分开销按 postings 线性、以排序为主，把多查询拼成 q·N + doc 一次 unique 反而更慢，
+        因此逐查询复用 score_candidates
+        """
+        return [self.top_k(q, k, mask) for q in queries_tokens]
+
+
+    def _select(self, cand: np.ndarray, s: np.ndarray, k: int,
+                mask: Optional[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        if mask is not None:
+            keep = mask[cand]
+            cand, s = cand[keep], s[keep]
+
+        def ranked(idx, sc, n):
+            # 部分选择出前 n（含边界同分），再按 (分数降序, 下标升序) 精排
+            if n <= 0:
+                return idx[:0], sc[:0]
+            if len(sc) > n:
+                kth = np.partition(sc, len(sc) - n)[len(sc) - n]
+                sel = sc >= kth
+                idx, sc = idx[sel], sc[sel]
+            order = np.lexsort((idx, -sc))[:n]
+            return idx[order], sc[order]
+
+        pos = s > 0
+        top_idx, top_sc = ranked(cand[pos], s[pos], k)
+        if len(top_idx) >= k:
+            return top_idx, top_sc
+
+        # 正分不足 k 个：依次补 0 分文档（按下标）与负分文档
+        need = k - len(top_idx)
+        nonzero = cand[s != 0]
+        pool = np.flatnonzero(mask) if mask is not None else np.arange(self.n_docs)
+        zeros = pool[~np.isin(pool, nonzero)][:need]
+        neg_idx, neg_sc = ranked(cand[s < 0], s[s < 0], need - len(zeros))
+        return (np.concatenate([top_idx, zeros, neg_idx]),
+                np.concatenate([top_sc, np.zeros(len(zeros)), neg_sc]))
@@ -0,0 +1,176 @@
+import os, json, time, uuid, shutil, sqlite3, hashlib, threading
+from pathlib import Path
+from contextlib import contextmanager
+
+
+
+def sha256_text(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def sha256_file(path, chunk_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+
+def _fsync(path, directory: bool = False) -> None:
+    fd = os.open(path, os.O_RDONLY | (getattr(os, "O_DIRECTORY", 0) if directory else 0))
+    try:
+        os.fsync(fd)
+    except OSError:                     # 部分文件系统 / 平台不支持对目录 fsync
+        pass
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def atomic_dir(path):
+    """
+    在 path 旁的临时目录中写出整个目录，成功后 fsync 并整体换入 path：
+    仍 mmap 着旧文件的读者不受影响（旧 inode 在解除映射前一直有效），
+    中途崩溃只留下被忽略的临时目录，path 要么是完整的旧版本、要么是完整的新版本（或不存在）
+        with atomic_dir(path) as tmp:
+            ...写入 tmp / "xxx"
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.tmp-{uuid.uuid4().hex[:8]}")
+    tmp.mkdir()
+    try:
+        yield tmp
+        for f in tmp.rglob("*"):
+            _fsync(f, directory=f.is_dir())
+        _fsync(tmp, directory=True)
+        # 非空目录不能被 rename 覆盖：旧目录先挪开再换入，随后删除（已 mmap 的读者不受影响）
+        old = path.with_name(f".{path.name}.old-{uuid.uuid4().hex[:8]}") if path.exists() else None
+        if old is not None:
+            os.replace(path, old)
+        os.replace(tmp, path)
+        _fsync(path.parent, directory=True)
+        if old is not None:
+            shutil.rmtree(old, ignore_errors=True)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+
+
+class KVCache():
+    """
+    基于 sqlite 的磁盘 KV 缓存（value 以 JSON 存储）
+      · 多线程共享同一连接，读写由锁串行化
+      · 记录 hits / misses，便于在进度条中展示命中率
+      · 给定 max_entries 时按最近访问时间做 LRU 淘汰（命中时刷新访问时间）
+    """
+    def __init__(self, path, max_entries: int = None):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path   = path
+        self.lock   = threading.Lock()
+        self.hits   = 0
+        self.misses = 0
+        self.evictions   = 0
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(str(path), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        if max_entries is not None:
+            cols = [r[1] for r in self.conn.execute("PRAGMA table_info(kv)")]
+            if "atime" not in cols:                     # 旧缓存文件补列
+                self.conn.execute("ALTER TABLE kv ADD COLUMN atime REAL NOT NULL DEFAULT 0")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS kv_atime ON kv (atime)")
+        self.conn.commit()
+
+
+    def _touch(self, keys) -> None:
+        """LRU 模式下刷新命中键的访问时间（调用方已持锁）"""
+        if self.max_entries is not None and keys:
+            now = time.time()
+            self.conn.executemany("UPDATE kv SET atime = ? WHERE key = ?", [(now, k) for k in keys])
+            self.conn.commit()
+
+
+    def _evict(self) -> None:
+        """超出 max_entries 时删除最久未访问的条目（调用方已持锁）"""
+        if self.max_entries is None:
+            return
+        extra = self.conn.execute("SELECT COUNT(*) FROM kv").fetchone()[0] - self.max_entries
+        if extra > 0:
+            self.conn.execute("DELETE FROM kv WHERE key IN (SELECT key FROM kv ORDER BY atime LIMIT ?)", (extra,))
+            self.conn.commit()
+            self.evictions += extra
+
+
+    def _upsert(self, rows) -> None:
+        if self.max_entries is None:
+            self.conn.executemany("INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)", rows)
+        else:
+            now = time.time()
+            self.conn.executemany("INSERT OR REPLACE INTO kv (key, value, atime) VALUES (?, ?, ?)",
+                                  [(k, v, now) for k, v in rows])
+        self.conn.commit()
+        self._evict()
+
+
+    def get(self, key: str, default=None):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._touch([key])
+        return json.loads(row[0])
+
+
+    def put(self, key: str, value) -> None:
+        payload = json.dumps(value, ensure_ascii=False)
+        with self.lock:
+            self._upsert([(key, payload)])
+
+
+    def get_many(self, keys) -> dict:
+        """批量查询，返回命中的 {key: value}"""
+        keys, found = list(keys), {}
+        with self.lock:
+            for i in range(0, len(keys), 900):          # sqlite 变量个数上限
+                part = keys[i:i + 900]
+                rows = self.conn.execute(
+                    f"SELECT key, value FROM kv WHERE key IN ({','.join('?' * len(part))})", part
+                ).fetchall()
+                found.update((k, v) for k, v in rows)
+            self.hits   += len(found)
+            self.misses += len(set(keys)) - len(found)
+            self._touch(list(found))
+        return {k: json.loads(v) for k, v in found.items()}
+
+
+    def put_many(self, items) -> None:
+        rows = [(k, json.dumps(v, ensure_ascii=False)) for k, v in items]
+        with self.lock:
+            self._upsert(rows)
+
+
+    def __contains__(self, key: str) -> bool:
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM kv WHERE key = ?", (key,)).fetchone() is not None
+
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM kv").fetchone()[0]
+
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else 0.0}
+
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
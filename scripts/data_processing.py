@@ -1,17 +1,19 @@
 import os, json
 from tqdm import tqdm
-from typing import List
+from html.parser import HTMLParser
+from typing import List, Optional
 from .prompts import CAPTION_PROMPT
-from dashscope import MultiModalConversation
+from .cache import KVCache, sha256_file, sha256_text
+from .utils import iter_kb
+from .dedup import PHashIndex, phash
+from .qwen_client import get_client
 from langchain.docstore.document import Document
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 
 
 
 # 初始化captioner
-qwen_key = os.getenv("DASHSCOPE_API_KEY")
-if not qwen_key:
-    raise RuntimeError("请先确保 DASHSCOPE_API_KEY 已正确设置并激活了 mmrag 环境")
+CAPTION_MODEL = 'qwen2.5-vl-7b-instruct' #'qwen2-vl-2b-instruct' free
 
 def img_cap(image_path):
     messages = [{"role": "system",
@@ -20,25 +22,38 @@ def img_cap(image_path):
                 'content': [{'image': image_path},   
                             {'text': CAPTION_PROMPT}
                            ]}]
-    response = MultiModalConversation.call(
-        # 若没有配置环境变量，请用百炼API Key将下行替换为：api_key="sk-xxx"
-        api_key=qwen_key,
-        model='qwen2.5-vl-7b-instruct', #'qwen2-vl-2b-instruct' free
-        messages=messages,
+    # 限速 / 重试 / 指标由共享的 QwenClient 统一处理（API Key 取自 DASHSCOPE_API_KEY）
+    return get_client().call_text(
+        CAPTION_MODEL,
+        messages,
         vl_high_resolution_images=False)
 
-    return response["output"]["choices"][0]["message"].content[0]["text"]
 
 
+def caption_key(image_path) -> str:
+    """缓存键 = 图像内容哈希 + 模型名 + CAPTION_PROMPT 哈希，任一变化都会重新 caption"""
+    return f"{sha256_file(image_path)}:{CAPTION_MODEL}:{sha256_text(CAPTION_PROMPT)[:16]}"
 
 
-def _process_image_inst(inst, IMAGE_ROOT):
-    """
-    辅助函数：给一个 inst 调用 img_cap 并返回一个 Document
-    """
+def cached_img_cap(image_path, cache: Optional[KVCache] = None) -> str:
+    """先查磁盘缓存，未命中再调用 img_cap 并写回"""
+    if cache is None:
+        return img_cap(image_path).strip()
+    key = caption_key(image_path)
+    descrip = cache.get(key)
+    if descrip is None:
+        descrip = img_cap(image_path).strip()
+        cache.put(key, descrip)
+    return descrip
+
+
+
+
+def _image_doc(inst, IMAGE_ROOT, descrip: str) -> Document:
+    """用 inst 自身的 caption / 位置信息 + 给定描述构造 image Document"""
     img_path = os.path.join(IMAGE_ROOT, inst["img_path"])
     cap_list = inst.get("img_caption") or []
-    descrip_list = [img_cap(img_path).strip()]
+    descrip_list = [descrip]
     return Document(
         page_content=" ".join(cap_list + descrip_list),
         metadata={
@@ -53,13 +68,15 @@ def _process_image_inst(inst, IMAGE_ROOT):
     )
 
 
-def _process_table_inst(inst, IMAGE_ROOT):
+def _table_doc(inst, IMAGE_ROOT, descrip: str, source: str = "vlm") -> Document:
     """
-    辅助函数：给一个 inst 调用 img_cap 并返回一个 Document
+    用 inst 自身的 caption / 位置信息 + 给定描述构造 table Document
+    source: "vlm" = 描述来自 img_cap；"body" = 来自 table_body 解析出的行列文本
+    缺少 img_path 的表格（只能走 "body"）metadata["img_path"] 为 None
     """
-    img_path = os.path.join(IMAGE_ROOT, inst["img_path"])
+    img_path = os.path.join(IMAGE_ROOT, inst["img_path"]) if inst.get("img_path") else None
     cap_list = inst.get("table_caption") or []
-    descrip_list = [img_cap(img_path).strip()]
+    descrip_list = [descrip]
     return Document(
         page_content=" ".join(cap_list + descrip_list),
         metadata={
@@ -69,22 +86,138 @@ def _process_table_inst(inst, IMAGE_ROOT):
             "img_path":    img_path,
             "table_caption": cap_list,
             "table_descrip": descrip_list,
+            "table_source":  source,
             **{b: inst.get(b) for b in ("table_body",) if inst.get(b) is not None},
             **{k: inst.get(k) for k in ("table_footnote",) if inst.get(k) is not None}
         }
     )
 
 
+def _process_image_inst(inst, IMAGE_ROOT, cache: Optional[KVCache] = None):
+    """
+    辅助函数：给一个 inst 调用 img_cap（优先查 cache）并返回一个 Document
+    """
+    img_path = os.path.join(IMAGE_ROOT, inst["img_path"])
+    return _image_doc(inst, IMAGE_ROOT, cached_img_cap(img_path, cache))
+
+
+def _process_table_inst(inst, IMAGE_ROOT, cache: Optional[KVCache] = None):
+    """
+    辅助函数：给一个 inst 调用 img_cap（优先查 cache）并返回一个 Document
+    """
+    img_path = os.path.join(IMAGE_ROOT, inst["img_path"])
+    return _table_doc(inst, IMAGE_ROOT, cached_img_cap(img_path, cache))
+
+
+
+
+class _TableHTMLParser(HTMLParser):
+    """把 MinerU 的 table_body HTML 解析为 rows: List[List[str]]"""
+    def __init__(self):
+        super().__init__()
+        self.rows, self.row, self.cell = [], None, None
+
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "tr":
+            self.row = []
+        elif tag in {"td", "th"}:
+            self.cell = []
+        elif tag == "br" and self.cell is not None:
+            self.cell.append(" ")
+
+
+    def handle_endtag(self, tag):
+        if tag in {"td", "th"} and self.cell is not None:
+            if self.row is None:
+                self.row = []
+            self.row.append(" ".join("".join(self.cell).split()))
+            self.cell = None
+        elif tag == "tr" and self.row is not None:
+            self.rows.append(self.row)
+            self.row = None
+
+
+    def handle_data(self, data):
+        if self.cell is not None:
+            self.cell.append(data)
+
+
+def parse_table_body(table_body) -> List[List[str]]:
+    if not table_body:
+        return []
+    parser = _TableHTMLParser()
+    parser.feed(table_body)
+    parser.close()
+    return [r for r in parser.rows if r]
+
+
+def table_rows_to_text(rows: List[List[str]]) -> str:
+    """行内用 " | " 分隔单元格，行间换行，供检索索引使用"""
+    return "\n".join(" | ".join(r) for r in rows)
+
+
+def table_body_ok(rows: List[List[str]], min_rows: int = 2, min_fill: float = 0.5) -> bool:
+    """
+    质量检查：至少 min_rows 行、至少一行有 ≥2 列，且非空单元格比例 ≥ min_fill；
+    不满足（解析失败 / 大面积空白）的表格回退到 VLM caption
+    """
+    cells = [c for r in rows for c in r]
+    if len(rows) < min_rows or not cells or max(len(r) for r in rows) < 2:
+        return False
+    return sum(1 for c in cells if c) / len(cells) >= min_fill
+
+
+
+def media_key(typ: str, inst: dict) -> str:
+    """image/table inst 在 journal 中的唯一键"""
+    return f"{typ}|{inst.get('book_idx', -1)}|{inst.get('page_idx', -1)}|{inst.get('img_path', '')}"
+
+
+def load_journal(journal_path) -> dict:
+    """
+    读取 checkpoint journal（JSONL，每行一个已完成的 Document）
+    返回 {media_key: Document}；进程崩溃时写了一半的末行会被忽略
+    """
+    done = {}
+    if not journal_path or not os.path.exists(journal_path):
+        return done
+    with open(journal_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            done[rec["key"]] = Document(page_content=rec["page_content"], metadata=rec["metadata"])
+    return done
+
+
+def _open_journal(journal_path):
+    """以追加方式打开 journal；若上次崩溃留下不完整的末行，先补一个换行，避免新记录与残行粘连"""
+    torn = False
+    if os.path.exists(journal_path) and os.path.getsize(journal_path) > 0:
+        with open(journal_path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            torn = f.read(1) != b"\n"
+    f = open(journal_path, "a", encoding="utf-8")
+    if torn:
+        f.write("\n")
+    return f
+
+
+def _append_journal(f, key: str, doc: Document) -> None:
+    rec = {"key": key, "page_content": doc.page_content, "metadata": doc.metadata}
+    f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+    f.flush()
+
 
 
 def load_corpus(KB_PATH, IMAGE_ROOT, parallel_image_workers: int = 16) -> List[Document]:
     docs: List[Document] = []
-    with open(KB_PATH, encoding="utf-8") as f:
-        all_insts = json.load(f)
 
     # 1) 先把非 image 类型的都处理好
     image_insts = []
-    for inst in all_insts:
+    for inst in iter_kb(KB_PATH):
         t = inst.get("type")
         if t == "text":
             docs.append(Document(
@@ -146,77 +279,204 @@ def load_corpus(KB_PATH, IMAGE_ROOT, parallel_image_workers: int = 16) -> List[D
 
 
 
-def load_corpus_parallel(KB_PATH, IMAGE_ROOT, parallel_image_workers: int = 16) -> List[Document]:
+def _inst_to_doc(inst) -> Optional[Document]:
+    """text / equation inst 直接转为 Document，其余类型返回 None"""
+    t = inst.get("type")
+    if t == "text":
+        return Document(
+            page_content=inst["text"],
+            metadata={
+                "type":     "text",
+                "book_idx": inst.get("book_idx", -1),
+                "page_idx": inst.get("page_idx", -1),
+                **{k: inst.get(k) for k in ("text_level",) if inst.get(k) is not None}
+            },
+        )
+    if t == "equation":
+        return Document(
+            page_content=inst["text"],
+            metadata={
+                "type":     "equation",
+                "book_idx": inst.get("book_idx", -1),
+                "page_idx": inst.get("page_idx", -1),
+                **{k: inst.get(k) for k in ("text_format",) if inst.get(k) is not None}
+            },
+        )
+    return None
+
+
+
+def load_corpus_parallel(KB_PATH, IMAGE_ROOT, parallel_image_workers: int = 16,
+                         caption_cache: Optional[str] = None,
+                         journal_path: Optional[str] = None,
+                         max_pending: Optional[int] = None,
+                         dedup: bool = False,
+                         phash_distance: int = 4,
+                         table_phash_distance: int = 0,
+                         table_mode: str = "auto",
+                         failed_insts: Optional[list] = None,
+                         skipped_insts: Optional[list] = None) -> List[Document]:
     """
-    读取 KB_PATH → 解析四类 inst → 并行调用 Qwen-VL
-      · image  : 调用 _process_image_inst → caption+description
-      · table  : 调用 _process_table_inst → caption+LLM description
+    流式读取 KB_PATH → 解析四类 inst → 并行调用 Qwen-VL
+      · image  : caption+description
+      · table  : caption+table_body 行列文本，或 caption+LLM description
       · text   : 直接写入
       · equation: 直接写入
+    KB_PATH      : 合并后的 JSON 文件，或直接给逐书 JSON 所在的 CORPUS_PATH 目录，
+                   也可以是 inst 的可迭代对象（增量构建时只传变化的书）
+    caption_cache: caption 磁盘缓存路径(sqlite)，重建知识库时命中的图/表不再调用 VLM
+    journal_path : checkpoint journal(JSONL)，每完成一个图/表即追加写入；
+                   重启后 journal 中已有的条目直接复用，只重试失败或缺失的 img_path
+    max_pending  : 同时在途的 caption 任务上限（默认 4 × workers），读取端据此背压，
+                   峰值内存由该队列长度而非语料大小决定
+    dedup        : 按感知哈希把相同/近似的图（表）归组，每组只 caption 代表图，
+                   描述分发给组内每个实例（各自保留 caption / book_idx / page_idx）
+    phash_distance / table_phash_distance:
+                   判为同组的最大汉明距离；表格版式相近但数字不同，默认只合并 pHash 完全相同的表
+    table_mode   : "auto" = 已有 table_body 且通过质量检查的表直接解析为行列文本，其余才 caption；
+                   "vlm"  = 所有表格都走 img_cap
+    failed_insts : 若给定，caption 失败（VLM / IO 错误，可重试）的 image/table inst 追加到该列表，
+                   调用方据此判断哪些书不完整
+    skipped_insts: 若给定，缺少 img_path 而无法处理的 inst 追加到该列表；这类跳过是永久性的，
+                   重跑也不会改变，不应计为失败
     返回统一的 docs 列表
     """
+    if table_mode not in {"auto", "vlm"}:
+        raise ValueError(f"未知 table_mode: {table_mode!r}")
+    cache = KVCache(caption_cache) if caption_cache else None
+    done  = load_journal(journal_path)
+    if done:
+        print(f"Resuming from journal: {len(done)} media documents already captioned")
+    max_pending = max_pending or 4 * parallel_image_workers
+    indexes = {"image": PHashIndex(phash_distance),
+               "table": PHashIndex(table_phash_distance)} if dedup else None
+
     docs: List[Document] = []
-    # ------- 读取原始 JSON -------
-    with open(KB_PATH, encoding="utf-8") as f:
-        all_insts = json.load(f)
+    failed, skipped = [], []
+    n_shared, n_body = 0, 0
+    jf   = _open_journal(journal_path) if journal_path else None
+    pbar = tqdm(desc="Captioning media (image+table)", unit="item")
 
-    # ------- 按类型分桶 -------
-    image_insts, table_insts = [], []
-    for inst in all_insts:
-        t = inst.get("type")
-        if t == "text":
-            docs.append(
-                Document(
-                    page_content=inst["text"],
-                    metadata={
-                        "type":     "text",
-                        "book_idx": inst.get("book_idx", -1),
-                        "page_idx": inst.get("page_idx", -1),
-                        **{k: inst.get(k) for k in ("text_level",) if inst.get(k) is not None}
-                    },
-                )
-            )
-        elif t == "equation":
-            docs.append(
-                Document(
-                    page_content=inst["text"],
-                    metadata={
-                        "type":     "equation",
-                        "book_idx": inst.get("book_idx", -1),
-                        "page_idx": inst.get("page_idx", -1),
-                        **{k: inst.get(k) for k in ("text_format",) if inst.get(k) is not None}
-                    },
-                )
-            )
-        elif t == "image":
-            image_insts.append(inst)
-        elif t == "table":
-            table_insts.append(inst)
-        # 其它类型可继续 elif
+    def emit(typ, inst, descrip):
+        build = _image_doc if typ == "image" else _table_doc
+        doc = build(inst, IMAGE_ROOT, descrip)
+        docs.append(doc)
+        if jf is not None:
+            _append_journal(jf, media_key(typ, inst), doc)
+        pbar.update(1)
+
+    def collect(fut, group):
+        # group: 共享同一次 caption 的实例组 {"descrip", "failed", "waiters"}
+        try:
+            group["descrip"] = fut.result()
+        except Exception as e:
+            group["failed"] = True
+            for typ, inst in group["waiters"]:
+                failed.append(inst)
+                print(f"[Error] {typ} inst {inst.get('img_path')} caption failed: {e}")
+                pbar.update(1)
+        else:
+            for typ, inst in group["waiters"]:
+                emit(typ, inst, group["descrip"])
+        group["waiters"] = []
+        if cache is not None:
+            pbar.set_postfix(hit=cache.hits, miss=cache.misses)
 
-    # ------- 并行处理 image & table -------
-    media_total = len(image_insts) + len(table_insts)
-    if media_total:
+    # ------- 流式读取 → 按类型分桶 → 有界队列并行处理 image & table -------
+    try:
         with ThreadPoolExecutor(max_workers=parallel_image_workers) as ex:
-            fut2inst = {}
-
-            # 提交任务
-            for inst in image_insts:
-                fut2inst[ex.submit(_process_image_inst, inst, IMAGE_ROOT)] = ("image", inst)
-            for inst in table_insts:
-                fut2inst[ex.submit(_process_table_inst, inst, IMAGE_ROOT)] = ("table", inst)
-
-            # 收集结果
-            for fut in tqdm(
-                as_completed(fut2inst),
-                total=media_total,
-                desc="Captioning media (image+table)",
-            ):
-                typ, inst = fut2inst[fut]
-                try:
-                    docs.append(fut.result())
-                except Exception as e:
-                    print(f"[Error] {typ} inst {inst.get('img_path')} caption failed: {e}")
+            fut2group = {}
+            source = iter_kb(KB_PATH) if isinstance(KB_PATH, (str, os.PathLike)) else KB_PATH
+            for inst in source:
+                t = inst.get("type")
+                if t in {"text", "equation"}:
+                    docs.append(_inst_to_doc(inst))
+                    continue
+                if t not in {"image", "table"}:      # 其它类型可继续扩展
+                    continue
+
+                # 结构化表格：直接用 table_body，无需 VLM
+                if t == "table" and table_mode == "auto":
+                    rows = parse_table_body(inst.get("table_body"))
+                    if table_body_ok(rows):
+                        docs.append(_table_doc(inst, IMAGE_ROOT, table_rows_to_text(rows), source="body"))
+                        n_body += 1
+                        continue
+
+                key = media_key(t, inst)
+                if key in done:
+                    docs.append(done[key])
+                    continue
+                pbar.total = (pbar.total or 0) + 1
+                if not inst.get("img_path"):
+                    # 缺少 img_path 无法 caption：表格退回纯文本（caption + table_body 中能解析出的行列），
+                    # 其余记为跳过（永久性的，重跑也无法补齐），不影响其余条目
+                    text = table_rows_to_text(parse_table_body(inst.get("table_body"))) if t == "table" else ""
+                    if text or (t == "table" and inst.get("table_caption")):
+                        docs.append(_table_doc(inst, IMAGE_ROOT, text, source="body"))
+                        n_body += 1
+                        pbar.update(1)
+                        continue
+                    skipped.append(inst)
+                    print(f"[Warn] {t} inst {key} has no img_path, skipped")
+                    pbar.update(1)
+                    continue
+                img_path = os.path.join(IMAGE_ROOT, inst["img_path"])
+
+                # 近重复图：挂到已有组上，不再单独 caption
+                group, h = None, None
+                if indexes is not None:
+                    try:
+                        h = phash(img_path)
+                        group = indexes[t].find(h)
+                    except Exception as e:
+                        print(f"[Warn] phash failed for {img_path}: {e}")
+                if group is not None and not group["failed"]:
+                    n_shared += 1
+                    if group["descrip"] is not None:
+                        emit(t, inst, group["descrip"])
+                    else:
+                        group["waiters"].append((t, inst))
+                    continue
+
+                fut = ex.submit(cached_img_cap, img_path, cache)
+                if group is None:
+                    group = {"descrip": None, "failed": False, "waiters": []}
+                    if h is not None:
+                        indexes[t].add(h, group)
+                group["failed"]  = False                   # 代表图曾失败则由本实例重新提交
+                group["waiters"] = [(t, inst)]
+                fut2group[fut] = group
+
+                # 背压：队列满时先收集已完成的任务
+                if len(fut2group) >= max_pending:
+                    finished, _ = wait(fut2group, return_when=FIRST_COMPLETED)
+                    for fut in finished:
+                        collect(fut, fut2group.pop(fut))
+
+            for fut in as_completed(list(fut2group)):
+                collect(fut, fut2group.pop(fut))
+    finally:
+        pbar.close()
+        if jf is not None:
+            jf.close()
 
+    if n_body:
+        print(f"Tables indexed from table_body without captioning: {n_body}")
+    if dedup:
+        print(f"Dedup: {n_shared} media insts reused the caption of a (near-)duplicate")
+    if failed_insts is not None:
+        failed_insts.extend(failed)
+    if skipped_insts is not None:
+        skipped_insts.extend(skipped)
+    if skipped:
+        print(f"[Warn] {len(skipped)} media insts skipped (no img_path)")
+    if failed:
+        print(f"[Warn] {len(failed)} media insts failed"
+              + ("，重新运行即可只重试这些条目" if journal_path else ""))
+    if cache is not None:
+        st = cache.stats()
+        print(f"Caption cache: {st['hits']} hits / {st['misses']} misses ({st['hit_rate']:.1%})")
+        cache.close()
     print(f"Loaded {len(docs)} documents")
     return docs
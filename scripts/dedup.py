@@ -0,0 +1,88 @@
+"""
+图 / 表截图的感知哈希去重：同一个 logo、插图或表格在不同页、不同书中反复出现，
+只需 caption 一次，再把描述分发给每个实例
+"""
+import numpy as np
+from PIL import Image
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+
+
+@lru_cache(maxsize=None)
+def _dct_matrix(n: int) -> np.ndarray:
+    """正交 DCT-II 变换矩阵"""
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    m = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    m[0] /= np.sqrt(2.0)
+    return m
+
+
+def phash(image_path, hash_size: int = 8, highfreq_factor: int = 4) -> int:
+    """
+    pHash：灰度 → 缩放到 (hash_size·highfreq_factor)² → 2D DCT →
+    取左上 hash_size² 低频系数，与其中位数比较得到 64 bit 指纹
+    """
+    size = hash_size * highfreq_factor
+    with Image.open(image_path) as img:
+        pixels = np.asarray(img.convert("L").resize((size, size), Image.LANCZOS), dtype=np.float64)
+    d = _dct_matrix(size)
+    low = (d @ pixels @ d.T)[:hash_size, :hash_size]
+    bits = (low > np.median(low)).flatten()
+    return int("".join("1" if b else "0" for b in bits), 2)
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+
+class PHashIndex():
+    """
+    近重复查找：把 n_bits 指纹切成 max_distance+1 段，
+    由抽屉原理，汉明距离 ≤ max_distance 的两个指纹至少有一段完全相同，
+    因此只需比较同段桶内的候选
+    """
+    def __init__(self, max_distance: int = 4, n_bits: int = 64):
+        self.max_distance = max_distance
+        n_bands = max_distance + 1
+        width = -(-n_bits // n_bands)
+        self.bands: List[Tuple[int, int]] = [
+            (lo, min(width, n_bits - lo)) for lo in range(0, n_bits, width)
+        ]
+        self.tables: List[Dict[int, List[int]]] = [dict() for _ in self.bands]
+        self.hashes: List[int] = []
+        self.values: List[object] = []
+
+
+    def _keys(self, h: int):
+        for lo, w in self.bands:
+            yield (h >> lo) & ((1 << w) - 1)
+
+
+    def add(self, h: int, value) -> None:
+        idx = len(self.hashes)
+        self.hashes.append(h)
+        self.values.append(value)
+        for table, key in zip(self.tables, self._keys(h)):
+            table.setdefault(key, []).append(idx)
+
+
+    def find(self, h: int) -> Optional[object]:
+        """返回距离最近（且 ≤ max_distance）的已登记 value，没有则 None"""
+        best, best_d = None, self.max_distance + 1
+        seen = set()
+        for table, key in zip(self.tables, self._keys(h)):
+            for idx in table.get(key, ()):
+                if idx in seen:
+                    continue
+                seen.add(idx)
+                d = hamming(h, self.hashes[idx])
+                if d < best_d:
+                    best, best_d = idx, d
+        return None if best is None else self.values[best]
+
+
+    def __len__(self) -> int:
+        return len(self.hashes)
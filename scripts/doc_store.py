@@ -0,0 +1,149 @@
+"""
+紧凑的二进制 Document 存储，替代 docs.json：
+  <dir>/meta.json      : 版本、条数、type 词表
+  <dir>/type.npy       : uint8   type 编码（列）
+  <dir>/book_idx.npy   : int32   book_idx（列，缺失为 -1）
+  <dir>/page_idx.npy   : int32   page_idx（列，缺失为 -1）
+  <dir>/text.bin       : 所有 page_content 的 UTF-8 拼接
+  <dir>/text_off.npy   : int64   N+1 个偏移
+  <dir>/meta.bin       : 每条完整 metadata 的 JSON（保证与 JSON 格式无损互转）
+  <dir>/meta_off.npy   : int64   N+1 个偏移
+打开时全部 mmap，按下标访问时才构造 Document；按 type/book_idx 过滤只读列，不解析正文
+"""
+import os, json, mmap
+import numpy as np
+from pathlib import Path
+from typing import Iterable, List, Optional
+from langchain.docstore.document import Document
+from .cache import atomic_dir
+
+
+
+STORE_VERSION = 1
+
+
+def write_doc_store(docs: Iterable[Document], path) -> int:
+    """
+    流式写出 docs，返回条数。先写入临时目录再整体换入 path，
+    仍在 mmap 旧版本的 DocStore 不受影响，中途崩溃也不会留下半新半旧的文件
+    """
+    with atomic_dir(path) as tmp:
+        return _write_files(docs, tmp)
+
+
+def _write_files(docs: Iterable[Document], path: Path) -> int:
+    types, type_codes, books, pages = [], [], [], []
+    text_off, meta_off = [0], [0]
+
+    with open(path / "text.bin", "wb") as ft, open(path / "meta.bin", "wb") as fm:
+        for d in docs:
+            md = d.metadata
+            t  = md.get("type")
+            if t not in types:
+                types.append(t)
+            type_codes.append(types.index(t))
+            books.append(md.get("book_idx", -1))
+            pages.append(md.get("page_idx", -1))
+
+            tb = d.page_content.encode("utf-8")
+            mb = json.dumps(md, ensure_ascii=False).encode("utf-8")
+            ft.write(tb)
+            fm.write(mb)
+            text_off.append(text_off[-1] + len(tb))
+            meta_off.append(meta_off[-1] + len(mb))
+
+    if len(types) > 255:
+        raise ValueError("type 种类超过 uint8 可编码范围")
+    np.save(path / "type.npy",     np.asarray(type_codes, dtype=np.uint8))
+    np.save(path / "book_idx.npy", np.asarray(books, dtype=np.int32))
+    np.save(path / "page_idx.npy", np.asarray(pages, dtype=np.int32))
+    np.save(path / "text_off.npy", np.asarray(text_off, dtype=np.int64))
+    np.save(path / "meta_off.npy", np.asarray(meta_off, dtype=np.int64))
+    with open(path / "meta.json", "w", encoding="utf-8") as f:
+        json.dump({"version": STORE_VERSION, "n": len(type_codes), "types": types}, f, ensure_ascii=False)
+    return len(type_codes)
+
+
+
+def _mmap_bytes(file_path):
+    if os.path.getsize(file_path) == 0:
+        return b""
+    with open(file_path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+
+class DocStore():
+    """只读、mmap 打开的 Document 序列，可直接替代 List[Document] 使用"""
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path / "meta.json", encoding="utf-8") as f:
+            info = json.load(f)
+        if info.get("version") != STORE_VERSION:
+            raise ValueError(f"不支持的 DocStore 版本: {info.get('version')}")
+        self.types    = info["types"]
+        self.type_col = np.load(self.path / "type.npy",     mmap_mode="r")
+        self.book_col = np.load(self.path / "book_idx.npy", mmap_mode="r")
+        self.page_col = np.load(self.path / "page_idx.npy", mmap_mode="r")
+        self.text_off = np.load(self.path / "text_off.npy", mmap_mode="r")
+        self.meta_off = np.load(self.path / "meta_off.npy", mmap_mode="r")
+        self.text_buf = _mmap_bytes(self.path / "text.bin")
+        self.meta_buf = _mmap_bytes(self.path / "meta.bin")
+
+
+    def __len__(self) -> int:
+        return len(self.type_col)
+
+
+    def text(self, i: int) -> str:
+        return self.text_buf[int(self.text_off[i]):int(self.text_off[i + 1])].decode("utf-8")
+
+
+    def metadata(self, i: int) -> dict:
+        return json.loads(self.meta_buf[int(self.meta_off[i]):int(self.meta_off[i + 1])].decode("utf-8"))
+
+
+    def type_of(self, i: int) -> str:
+        return self.types[self.type_col[i]]
+
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return Document(page_content=self.text(i), metadata=self.metadata(i))
+
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+    def select(self, type: Optional[str] = None, book_idx=None, page_idx=None) -> np.ndarray:
+        """只用列数据筛选，返回满足条件的下标；book_idx / page_idx 可为单值或集合"""
+        mask = np.ones(len(self), dtype=bool)
+        if type is not None:
+            if type not in self.types:
+                return np.empty(0, dtype=np.int64)
+            mask &= self.type_col == self.types.index(type)
+        for col, val in ((self.book_col, book_idx), (self.page_col, page_idx)):
+            if val is None:
+                continue
+            if np.isscalar(val):
+                mask &= col == val
+            else:
+                mask &= np.isin(col, np.fromiter(val, dtype=np.int64))
+        return np.flatnonzero(mask)
+
+
+    def filter(self, **conds) -> List[Document]:
+        return [self[int(i)] for i in self.select(**conds)]
+
+
+    def close(self) -> None:
+        for buf in (self.text_buf, self.meta_buf):
+            if isinstance(buf, mmap.mmap):
+                buf.close()
@@ -0,0 +1,162 @@
+"""
+稠密 embedding 阶段：
+  · EmbeddingCache : 以内容哈希为键的磁盘向量缓存（追加写的 float16 矩阵，mmap 读取），
+                     重建索引 / 换索引类型时直接复用未变化子块的向量
+  · CachedEmbeddings: LangChain Embeddings 实现，按 token 长度排序分批以减少 padding，
+                     workers > 1 时用 sentence-transformers 多进程池在 CPU 上分片编码
+"""
+import os, json
+import numpy as np
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+from langchain_core.embeddings import Embeddings
+from .cache import sha256_text
+
+
+
+class EmbeddingCache():
+    """
+    <dir>/meta.json   : {"model": ..., "dim": ...}
+    <dir>/vectors.f16 : 逐行追加的 float16 向量
+    <dir>/keys.txt    : 与 vectors 行号对应的内容哈希
+    先写向量再写键；打开时以两者较短者为准，并把多出的孤儿向量 / 写了一半的键截掉，
+    保证之后追加的行号与文件中的行对齐
+    """
+    def __init__(self, cache_dir, model_name: str):
+        self.dir = Path(cache_dir) / sha256_text(model_name)[:16]
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.model_name = model_name
+        self.dim: Optional[int] = None
+        self.rows: Dict[str, int] = {}
+        self.vectors = np.zeros((0, 0), dtype=np.float16)
+
+        meta = self.dir / "meta.json"
+        if meta.exists():
+            with open(meta, encoding="utf-8") as f:
+                self.dim = json.load(f)["dim"]
+            keys_path, vec_path = self.dir / "keys.txt", self.dir / "vectors.f16"
+            lines = keys_path.read_bytes().split(b"\n")[:-1] if keys_path.exists() else []   # 末段无换行即写了一半
+            n_vec = os.path.getsize(vec_path) // (2 * self.dim) if vec_path.exists() else 0
+            n = min(len(lines), n_vec)
+            with open(vec_path, "ab") as f:
+                f.truncate(n * 2 * self.dim)
+            with open(keys_path, "ab") as f:
+                f.truncate(sum(len(line) + 1 for line in lines[:n]))
+            self.rows = {line.decode("ascii"): i for i, line in enumerate(lines[:n])}
+            self._remap(n)
+
+
+    def _remap(self, n: int) -> None:
+        if n == 0:
+            self.vectors = np.zeros((0, self.dim or 0), dtype=np.float16)
+        else:
+            self.vectors = np.memmap(self.dir / "vectors.f16", dtype=np.float16, mode="r", shape=(n, self.dim))
+
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.rows
+
+
+    def get(self, keys: Sequence[str]) -> np.ndarray:
+        """按 keys 取出 float32 矩阵（调用方需保证全部命中）"""
+        return np.asarray(self.vectors[[self.rows[k] for k in keys]], dtype=np.float32)
+
+
+    def add(self, keys: Sequence[str], vectors: np.ndarray) -> None:
+        vectors = np.asarray(vectors, dtype=np.float16)
+        fresh = [i for i, k in enumerate(keys) if k not in self.rows]
+        if not fresh:
+            return
+        if self.dim is None:
+            self.dim = int(vectors.shape[1])
+            with open(self.dir / "meta.json", "w", encoding="utf-8") as f:
+                json.dump({"model": self.model_name, "dim": self.dim}, f)
+        n = len(self.rows)
+        with open(self.dir / "vectors.f16", "ab") as f:
+            f.write(vectors[fresh].tobytes())
+        with open(self.dir / "keys.txt", "a", encoding="utf-8") as f:
+            f.write("".join(f"{keys[i]}\n" for i in fresh))
+        for j, i in enumerate(fresh):
+            self.rows[keys[i]] = n + j
+        self._remap(len(self.rows))
+
+
+
+class CachedEmbeddings(Embeddings):
+    def __init__(
+        self,
+        model_name: str,
+        cache_dir: Optional[str] = None,
+        batch_size: int = 32,
+        workers: int = 1,
+        device: str = "cpu",
+        model_kwargs: Optional[dict] = None,
+    ):
+        self.model_name   = model_name
+        self.batch_size   = batch_size
+        self.workers      = workers
+        self.device       = device
+        self.model_kwargs = model_kwargs or {}
+        self.cache = EmbeddingCache(cache_dir, model_name) if cache_dir else None
+        self._model = None
+
+
+    @property
+    def model(self):
+        if self._model is None:
+            from sentence_transformers import SentenceTransformer
+            self._model = SentenceTransformer(self.model_name, device=self.device, **self.model_kwargs)
+        return self._model
+
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        """按 token 长度降序排好再分批，同批长度相近、padding 最少；结果按原顺序返回"""
+        lengths = [len(ids) for ids in self.model.tokenizer(texts, add_special_tokens=False)["input_ids"]]
+        order = np.argsort(-np.asarray(lengths), kind="stable")
+        sorted_texts = [texts[i] for i in order]
+
+        if self.workers > 1 and len(texts) > self.batch_size * self.workers:
+            pool = self.model.start_multi_process_pool([self.device] * self.workers)
+            try:
+                # 连续分片：每个 worker 拿到的一段长度也相近
+                chunk = -(-len(sorted_texts) // (self.workers * 4))
+                vecs = self.model.encode_multi_process(sorted_texts, pool, batch_size=self.batch_size,
+                                                       chunk_size=chunk)
+            finally:
+                self.model.stop_multi_process_pool(pool)
+        else:
+            vecs = self.model.encode(sorted_texts, batch_size=self.batch_size, convert_to_numpy=True)
+
+        out = np.empty_like(vecs)
+        out[order] = vecs
+        return out
+
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        texts = [t.replace("\n", " ") for t in texts]      # 与 HuggingFaceEmbeddings 相同的预处理
+        if self.cache is None:
+            return self._encode(texts).tolist()
+
+        keys = [sha256_text(t) for t in texts]
+        missing = list(dict.fromkeys(k for k in keys if k not in self.cache))
+        if missing:
+            first = {}
+            for k, t in zip(keys, texts):
+                first.setdefault(k, t)
+            self.cache.add(missing, self._encode([first[k] for k in missing]))
+        print(f"Embedding cache: {len(texts) - len(missing)} reused / {len(missing)} encoded")
+        # 统一从缓存读出（float16），新旧向量精度一致
+        return self.cache.get(keys).tolist()
+
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_queries([text])[0].tolist()
+
+
+    def embed_queries(self, texts: List[str]) -> np.ndarray:
+        """查询一次前向批量编码（不写缓存），返回 float32 矩阵"""
+        return np.asarray(self._encode([t.replace("\n", " ") for t in texts]), dtype=np.float32)
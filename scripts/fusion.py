@@ -0,0 +1,44 @@
+"""
+稠密 / 稀疏两路结果的父块级融合：
+  · rrf  : 加权倒数排名融合，子块第 r 名（从 1 起）贡献 w / (k + r)
+  · norm : 每路子块分数 min-max 归一化到 [0, 1] 后加权求和
+每一路先把子块分数按 parent_id 取最大值（最好的子块代表父块），再跨路加权相加
+"""
+import numpy as np
+from typing import Dict, List, Sequence, Tuple
+from langchain.docstore.document import Document
+
+
+
+FUSION_METHODS = {"rrf", "norm", "merge"}
+
+
+def leg_parent_scores(child_hits: Sequence[Document], scores: Sequence[float],
+                      method: str = "rrf", rrf_k: int = 60) -> Dict[str, float]:
+    """单路：子块（已按该路排序）→ {parent_id: 分数}，同一父块取子块最大值"""
+    if method == "rrf":
+        child_scores = [1.0 / (rrf_k + r) for r in range(1, len(child_hits) + 1)]
+    else:
+        s = np.asarray(scores, dtype=np.float64)
+        lo, hi = (s.min(), s.max()) if len(s) else (0.0, 0.0)
+        child_scores = ((s - lo) / (hi - lo) if hi > lo else np.ones(len(s))).tolist()
+
+    out: Dict[str, float] = {}
+    for c, v in zip(child_hits, child_scores):
+        pid = c.metadata["parent_id"]
+        if v > out.get(pid, -np.inf):
+            out[pid] = v
+    return out
+
+
+def fuse_legs(legs: Sequence[Tuple[Sequence[Document], Sequence[float], float]],
+              method: str = "rrf", rrf_k: int = 60) -> List[Tuple[str, float]]:
+    """
+    legs = [(child_hits, scores, weight), ...]，scores 越大越相关
+    返回按融合分数降序的 [(parent_id, score)]，同分保持首次出现的顺序
+    """
+    total: Dict[str, float] = {}
+    for child_hits, scores, weight in legs:
+        for pid, v in leg_parent_scores(child_hits, scores, method, rrf_k).items():
+            total[pid] = total.get(pid, 0.0) + weight * v
+    return sorted(total.items(), key=lambda kv: -kv[1])
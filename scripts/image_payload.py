@@ -0,0 +1,113 @@
+"""
+VLM 请求的图像载荷缓存：
+同一张页面截图在 caption / rerank / rewrite 中会被反复上传。这里按图像内容哈希生成一次
+限制像素数、重新压缩的 JPEG 变体并落盘，QwenClient 发请求前把消息里的本地 {"image": path} 换成变体路径。
+默认像素上限取 1280·28·28（关闭 vl_high_resolution_images 时模型侧的输入上限），缩放不损失模型实际看到的分辨率
+"""
+import os, uuid, threading
+from pathlib import Path
+from functools import lru_cache
+from PIL import Image
+from .cache import sha256_file
+
+
+
+VL_MAX_PIXELS = 1280 * 28 * 28
+
+
+@lru_cache(maxsize=65536)
+def _file_digest(path: str, mtime: float, size: int) -> str:
+    return sha256_file(path)
+
+
+class ImagePayloadCache():
+    def __init__(self, cache_dir, max_pixels: int = VL_MAX_PIXELS, quality: int = 85):
+        self.dir = Path(cache_dir)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.max_pixels = max_pixels
+        self.quality    = quality
+        self.lock   = threading.Lock()
+        self.hits   = 0
+        self.misses = 0
+        self.bytes_in  = 0          # 原图字节数（累计）
+        self.bytes_out = 0          # 实际上传的字节数（累计）
+
+
+    def variant(self, path: str) -> str:
+        """返回用于上传的图像路径；无法处理或压缩后不更小时返回原路径"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return path
+        out = self.dir / f"{_file_digest(path, st.st_mtime, st.st_size)[:32]}_p{self.max_pixels}_q{self.quality}.jpg"
+        if not out.exists():
+            with self.lock:
+                self.misses += 1
+            try:
+                self._render(path, out)
+            except Exception as e:
+                print(f"[Warn] image payload {path}: {e}")
+                return path
+        else:
+            with self.lock:
+                self.hits += 1
+
+        # 空文件是「变体不比原图小」的标记，直接用原图
+        size = out.stat().st_size
+        with self.lock:
+            self.bytes_in  += st.st_size
+            self.bytes_out += size or st.st_size
+        return str(out.resolve()) if size else path
+
+
+    def _render(self, path: str, out: Path) -> None:
+        with Image.open(path) as img:
+            img.load()
+            w, h = img.size
+            if w * h > self.max_pixels:
+                scale = (self.max_pixels / (w * h)) ** 0.5
+                img = img.resize((max(1, int(w * scale)), max(1, int(h * scale))), Image.LANCZOS)
+            if img.mode in {"RGBA", "LA", "P"}:
+                img = img.convert("RGBA")
+                bg  = Image.new("RGB", img.size, (255, 255, 255))
+                bg.paste(img, mask=img.getchannel("A"))
+                img = bg
+            elif img.mode != "RGB":
+                img = img.convert("RGB")
+
+            tmp = out.with_name(f"{out.name}.{uuid.uuid4().hex}.tmp")
+            try:
+                img.save(tmp, "JPEG", quality=self.quality, optimize=True)
+                if tmp.stat().st_size >= os.path.getsize(path):
+                    tmp.write_bytes(b"")
+                os.replace(tmp, out)                          # 并发生成同一变体时原子覆盖
+            finally:
+                if tmp.exists():
+                    tmp.unlink()
+
+
+    def rewrite_messages(self, messages):
+        """复制消息，把本地文件的 {"image": path} 换成缓存变体；URL / oss 等远程地址保持不变"""
+        out = []
+        for msg in messages:
+            content = msg.get("content") if isinstance(msg, dict) else None
+            if not isinstance(content, list):
+                out.append(msg)
+                continue
+            items = []
+            for item in content:
+                src = item.get("image") if isinstance(item, dict) else None
+                if isinstance(src, str) and src.startswith("file://"):
+                    item = {**item, "image": "file://" + self.variant(src[len("file://"):])}
+                elif isinstance(src, str) and "://" not in src:
+                    item = {**item, "image": self.variant(src)}
+                items.append(item)
+            out.append({**msg, "content": items})
+        return out
+
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "bytes_in": self.bytes_in, "bytes_out": self.bytes_out,
+                    "ratio": self.bytes_out / self.bytes_in if self.bytes_in else 1.0}
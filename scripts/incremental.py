@@ -0,0 +1,126 @@
+"""
+增量构建知识库：用 manifest 记录每本书的文件哈希与稳定的 book_idx，
+只把新增 / 修改 / 删除的书送进 captioning 与切块，其余直接复用
+"""
+import os, json
+from pathlib import Path
+from typing import List, Tuple
+from langchain.docstore.document import Document
+from .cache import sha256_file
+from .utils import list_book_files, iter_book_insts
+from .data_processing import load_corpus_parallel
+
+
+
+def load_manifest(path) -> dict:
+    """
+    manifest 格式：
+      {"next_book_idx": int,
+       "books": {相对路径: {"book_idx": int, "sha256": str}}}
+    """
+    if path and os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    return {"next_book_idx": 0, "books": {}}
+
+
+def save_manifest(manifest: dict, path) -> None:
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+
+def scan_books(CORPUS_PATH, manifest: dict) -> Tuple[dict, dict]:
+    """
+    对比 CORPUS_PATH 当前的逐书 JSON 与 manifest，返回 (new_manifest, delta)
+      delta = {"added":   [(book_idx, path)],
+               "changed": [(book_idx, path)],
+               "removed": [book_idx],
+               "unchanged": [book_idx]}
+    已有书保持原 book_idx；首次建 manifest 时按排序顺序编号，与 merge_corpus 一致
+    """
+    root  = Path(CORPUS_PATH)
+    old   = manifest.get("books", {})
+    books = {}
+    next_idx = manifest.get("next_book_idx", 0)
+    delta = {"added": [], "changed": [], "removed": [], "unchanged": []}
+
+    for json_file in list_book_files(root):
+        rel    = json_file.relative_to(root).as_posix()
+        digest = sha256_file(json_file)
+        if rel in old:
+            book_idx = old[rel]["book_idx"]
+            bucket = "unchanged" if old[rel]["sha256"] == digest else "changed"
+        else:
+            book_idx, next_idx = next_idx, next_idx + 1
+            bucket = "added"
+        books[rel] = {"book_idx": book_idx, "sha256": digest}
+        delta[bucket].append(book_idx if bucket == "unchanged" else (book_idx, json_file))
+
+    delta["removed"] = [info["book_idx"] for rel, info in old.items() if rel not in books]
+    return {"next_book_idx": next_idx, "books": books}, delta
+
+
+
+def bootstrap_manifest(CORPUS_PATH, MANIFEST_PATH) -> dict:
+    """
+    为已用 merge_corpus 全量构建过的知识库登记 manifest（不重新处理任何书），
+    book_idx 沿用 merge_corpus 的排序编号
+    """
+    manifest, _ = scan_books(CORPUS_PATH, {"next_book_idx": 0, "books": {}})
+    save_manifest(manifest, MANIFEST_PATH)
+    print(f"Registered {len(manifest['books'])} books in {MANIFEST_PATH}")
+    return manifest
+
+
+
+def update_kb(
+    CORPUS_PATH,
+    IMAGE_ROOT,
+    docs: List[Document],
+    MANIFEST_PATH,
+    **load_kwargs,
+) -> Tuple[List[Document], dict]:
+    """
+    增量更新 docs：
+      · 删除 / 修改过的书，其旧 Document 全部移除
+      · 新增 / 修改过的书，经 load_corpus_parallel 重新处理（load_kwargs 透传，如 caption_cache）
+      · 其余书的 Document 原样保留
+    返回 (docs, delta)，
+    delta["stale_books"] 为需要从切块 / 索引中剔除的 book_idx，delta["new_docs"] 为新处理出的 Document，
+    delta["manifest"] 为新的 manifest，delta["incomplete_books"] 为解析或 caption 有失败的 book_idx，
+    delta["skipped_insts"] 为缺少 img_path 而永久跳过的 inst（不计入 incomplete_books）。
+    本函数不写 manifest：调用方须在 docs / 切块 / 索引都持久化之后再
+    save_manifest(delta["manifest"], MANIFEST_PATH)，否则中途崩溃会让下次运行误以为这些书已是最新
+    """
+    manifest = load_manifest(MANIFEST_PATH)
+    new_manifest, delta = scan_books(CORPUS_PATH, manifest)
+    todo  = delta["added"] + delta["changed"]
+    # 新增书的 book_idx 也算 stale：若 docs 来自未登记 manifest 的旧构建，避免重复
+    stale = set(delta["removed"]) | {b for b, _ in todo}
+    print(f"Books: {len(delta['added'])} added, {len(delta['changed'])} changed, "
+          f"{len(delta['removed'])} removed, {len(delta['unchanged'])} unchanged")
+
+    incomplete, failed, skipped = set(), [], []
+    insts = (inst for book_idx, path in todo for inst in iter_book_insts(path, book_idx, incomplete))
+    new_docs = load_corpus_parallel(insts, IMAGE_ROOT, failed_insts=failed, skipped_insts=skipped,
+                                    **load_kwargs) if todo else []
+    # 只有可重试的失败才让书不完整；缺少 img_path 的跳过重跑也无法补齐
+    incomplete |= {inst.get("book_idx") for inst in failed}
+
+    # 不完整的书保留 book_idx 但不记哈希：下次运行视为 changed，先剔除本次的部分结果再整本重试
+    for info in new_manifest["books"].values():
+        if info["book_idx"] in incomplete:
+            info["sha256"] = None
+    if incomplete:
+        print(f"[Warn] {len(incomplete)} books incomplete, will be retried next run: {sorted(incomplete)}")
+
+    kept = [d for d in docs if d.metadata.get("book_idx") not in stale]
+    delta["stale_books"] = stale
+    delta["new_docs"]    = new_docs
+    delta["manifest"]    = new_manifest
+    delta["incomplete_books"] = incomplete
+    delta["skipped_insts"]    = skipped
+    return kept + new_docs, delta
@@ -0,0 +1,72 @@
+"""
+原始条目的位置索引：(book_idx, page_idx) → type → 文档下标
+启动时构建一次，related_equs / 邻页上下文查询只触及命中的页，不再逐条扫描 docs；
+docs 为 DocStore 时直接读取其 type / book_idx / page_idx 列，不反序列化 metadata
+"""
+import numpy as np
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+from langchain.docstore.document import Document
+from .doc_store import DocStore
+
+
+
+class LocationIndex():
+    def __init__(self, docs):
+        self.docs = docs
+        if isinstance(docs, DocStore):
+            books = np.asarray(docs.book_col, dtype=np.int64)
+            pages = np.asarray(docs.page_col, dtype=np.int64)
+            codes = np.asarray(docs.type_col, dtype=np.int64)
+            self.types = list(docs.types)
+        else:
+            self.types, codes, books, pages = [], [], [], []
+            code_of = {}
+            for d in docs:
+                t = d.metadata["type"]
+                if t not in code_of:
+                    code_of[t] = len(self.types)
+                    self.types.append(t)
+                codes.append(code_of[t])
+                books.append(d.metadata.get("book_idx", -1))
+                pages.append(d.metadata.get("page_idx", -1))
+            books, pages, codes = (np.asarray(a, dtype=np.int64) for a in (books, pages, codes))
+
+        # 按 (book, page, type, 原下标) 排序后切分，同一位置同一类型内保持 docs 中的顺序
+        n = len(codes)
+        order = np.lexsort((np.arange(n), codes, pages, books))
+        b, p, c = books[order], pages[order], codes[order]
+        starts = np.flatnonzero(np.r_[True, (b[1:] != b[:-1]) | (p[1:] != p[:-1]) | (c[1:] != c[:-1])]) if n else []
+        ends = np.r_[starts[1:], n] if n else []
+
+        self.by_loc: Dict[Tuple[int, int], Dict[str, np.ndarray]] = {}
+        for s, e in zip(starts, ends):
+            self.by_loc.setdefault((int(b[s]), int(p[s])), {})[self.types[c[s]]] = order[s:e]
+
+
+    def __len__(self) -> int:
+        return len(self.by_loc)
+
+
+    def at(self, book_idx: int, page_idx: int, types: Optional[Iterable[str]] = None) -> np.ndarray:
+        """某一页上（指定类型）的文档下标，按 docs 中的顺序"""
+        groups = self.by_loc.get((book_idx, page_idx), {})
+        parts = [idx for t, idx in groups.items() if types is None or t in types]
+        return np.sort(np.concatenate(parts)) if parts else np.empty(0, dtype=np.int64)
+
+
+    def lookup(self, locs: Iterable[Tuple[int, int]], types: Optional[Iterable[str]] = None,
+               window: int = 0) -> List[int]:
+        """
+        locs 中每页及其 ±window 页上（指定类型）的文档下标，按 locs 顺序、页号由近到远，去重
+        """
+        types = set(types) if types is not None else None
+        out = {}
+        for book, page in locs:
+            for off in sorted(range(-window, window + 1), key=abs):
+                for i in self.at(book, page + off, types).tolist():
+                    out.setdefault(i, None)
+        return list(out)
+
+
+    def documents(self, indices: Sequence[int]) -> List[Document]:
+        return [self.docs[int(i)] for i in indices]
@@ -0,0 +1,237 @@
+"""
+DashScope 调用的共享客户端层：captioning / reranking / rewriting 都经由这里发请求
+  · 每个模型一个 token bucket 限速（请求/秒 + 突发容量）
+  · 全局并发上限，多个模块的线程池共享
+  · 遇到限流 / 5xx / 网络错误时按 jittered 指数退避重试
+  · 记录每次调用的延迟与 token 用量
+  · 可选：消息中的本地图像先换成按内容哈希缓存的缩放 / 重压缩变体（ImagePayloadCache，QWEN_IMAGE_CACHE 启用）
+base_url / call_fn 可指向本地 fake endpoint，便于离线测试
+"""
+import os, time, random, asyncio, threading
+from collections import defaultdict, deque
+from http import HTTPStatus
+from typing import Callable, Dict, Optional
+from dotenv import load_dotenv
+from dashscope import MultiModalConversation
+from .image_payload import ImagePayloadCache
+
+
+
+load_dotenv()
+RETRYABLE_STATUS = {HTTPStatus.TOO_MANY_REQUESTS, HTTPStatus.INTERNAL_SERVER_ERROR,
+                    HTTPStatus.BAD_GATEWAY, HTTPStatus.SERVICE_UNAVAILABLE,
+                    HTTPStatus.GATEWAY_TIMEOUT}
+
+
+class QwenAPIError(RuntimeError):
+    def __init__(self, status_code, code, message):
+        super().__init__(f"[{status_code}] {code}: {message}")
+        self.status_code = status_code
+        self.code        = code
+
+
+    @property
+    def retryable(self) -> bool:
+        return (self.status_code in RETRYABLE_STATUS
+                or str(self.code or "").startswith("Throttling"))
+
+
+
+class TokenBucket():
+    """经典 token bucket：rate 个/秒 匀速补充，最多累积 capacity 个"""
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate     = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self.tokens   = self.capacity
+        self.stamp    = time.monotonic()
+        self.lock     = threading.Lock()
+
+
+    def acquire(self, n: float = 1.0) -> float:
+        """阻塞直到拿到 n 个 token，返回等待的秒数"""
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp  = now
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return waited
+                delay = (n - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+
+def _field(resp, key, default=None):
+    """DashScope 响应既支持 resp[key] 也支持属性访问，fake endpoint 可能只给 dict"""
+    try:
+        val = resp[key]
+    except (KeyError, TypeError):
+        val = getattr(resp, key, None)
+    return default if val is None else val
+
+
+def response_text(resp) -> str:
+    """取出 MultiModalConversation 响应中的首段文本"""
+    msg = _field(resp, "output")["choices"][0]["message"]
+    content = msg["content"] if isinstance(msg, dict) else msg.content
+    return content[0]["text"]
+
+
+
+class QwenClient():
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        rate_limits: Optional[Dict[str, float]] = None,   # model → 请求/秒
+        default_rate: float = 5.0,
+        burst: Optional[float] = None,
+        max_concurrency: int = 16,
+        max_retries: int = 5,
+        backoff_base: float = 1.0,
+        backoff_max: float = 30.0,
+        base_url: Optional[str] = None,
+        call_fn: Optional[Callable] = None,
+        image_cache: Optional[ImagePayloadCache] = None,
+    ):
+        self.api_key = api_key or os.getenv("DASHSCOPE_API_KEY")
+        if not self.api_key and call_fn is None and base_url is None:
+            raise RuntimeError("请先确保 DASHSCOPE_API_KEY 已正确设置并激活了 mmrag 环境")
+        self.rate_limits  = dict(rate_limits or {})
+        self.default_rate = default_rate
+        self.burst        = burst
+        self.max_retries  = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max  = backoff_max
+        self.base_url     = base_url
+        self.call_fn      = call_fn or MultiModalConversation.call
+        self.image_cache  = image_cache
+
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.lock      = threading.Lock()
+        self.reset_metrics()
+
+
+    # ---------- 限速 ----------
+    def _bucket(self, model: str) -> TokenBucket:
+        with self.lock:
+            if model not in self.buckets:
+                rate = self.rate_limits.get(model, self.default_rate)
+                self.buckets[model] = TokenBucket(rate, self.burst)
+            return self.buckets[model]
+
+
+    def _backoff(self, attempt: int) -> float:
+        """full jitter：在 [0, min(max, base·2^attempt)] 中均匀取值，避免 429 同步重试"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+
+    # ---------- 指标 ----------
+    def reset_metrics(self) -> None:
+        with self.lock:
+            self._metrics = defaultdict(lambda: {
+                "calls": 0, "errors": 0, "retries": 0, "throttled": 0,
+                "input_tokens": 0, "output_tokens": 0,
+                "latency_sum": 0.0, "latencies": deque(maxlen=10000),
+            })
+
+
+    def _record(self, model: str, latency: float, resp=None, error: Optional[Exception] = None,
+                retried: bool = False) -> None:
+        usage = _field(resp, "usage", {}) if resp is not None else {}
+        with self.lock:
+            m = self._metrics[model]
+            m["calls"] += 1
+            m["latency_sum"] += latency
+            m["latencies"].append(latency)
+            m["retries"] += int(retried)
+            if error is not None:
+                m["errors"] += 1
+                if isinstance(error, QwenAPIError) and error.retryable:
+                    m["throttled"] += 1
+            m["input_tokens"]  += int(_field(usage, "input_tokens", 0))
+            m["output_tokens"] += int(_field(usage, "output_tokens", 0))
+
+
+    def metrics(self) -> Dict[str, dict]:
+        """每个模型的调用次数 / 错误 / 重试 / token 用量 / 延迟(p50, p95, mean)"""
+        out = {}
+        with self.lock:
+            for model, m in self._metrics.items():
+                lat = sorted(m["latencies"])
+                pick = lambda q: lat[min(len(lat) - 1, int(q * len(lat)))] if lat else 0.0
+                out[model] = {
+                    **{k: v for k, v in m.items() if k not in {"latencies", "latency_sum"}},
+                    "latency_mean": m["latency_sum"] / m["calls"] if m["calls"] else 0.0,
+                    "latency_p50":  pick(0.50),
+                    "latency_p95":  pick(0.95),
+                }
+        return out
+
+
+    # ---------- 调用 ----------
+    def call(self, model: str, messages, **kwargs):
+        """同步调用，内部完成限速、并发控制与重试；最终失败时抛出异常"""
+        if self.base_url is not None:
+            kwargs.setdefault("base_address", self.base_url)
+        # 高分辨率模式下模型要看原图，不做缩放
+        if self.image_cache is not None and not kwargs.get("vl_high_resolution_images"):
+            messages = self.image_cache.rewrite_messages(messages)
+        for attempt in range(self.max_retries + 1):
+            self._bucket(model).acquire()
+            with self.semaphore:
+                t0 = time.perf_counter()
+                try:
+                    resp = self.call_fn(api_key=self.api_key, model=model, messages=messages, **kwargs)
+                    status = _field(resp, "status_code", HTTPStatus.OK)
+                    if status != HTTPStatus.OK:
+                        raise QwenAPIError(status, _field(resp, "code"), _field(resp, "message"))
+                except (QwenAPIError, OSError) as e:
+                    self._record(model, time.perf_counter() - t0, error=e, retried=attempt > 0)
+                    retryable = not isinstance(e, QwenAPIError) or e.retryable
+                    if not retryable or attempt == self.max_retries:
+                        raise
+                    err = e
+                else:
+                    self._record(model, time.perf_counter() - t0, resp=resp, retried=attempt > 0)
+                    return resp
+            delay = self._backoff(attempt)
+            print(f"[Retry] {model} attempt {attempt + 1}/{self.max_retries}: {err}; sleep {delay:.1f}s")
+            time.sleep(delay)
+
+
+    def call_text(self, model: str, messages, **kwargs) -> str:
+        return response_text(self.call(model, messages, **kwargs))
+
+
+    async def acall(self, model: str, messages, **kwargs):
+        """asyncio 版本：在线程中执行 call，仍共享同一套限速与并发上限"""
+        return await asyncio.to_thread(self.call, model, messages, **kwargs)
+
+
+
+_client: Optional[QwenClient] = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> QwenClient:
+    """
+    进程内共享的默认客户端（首次使用时创建）
+    图像变体缓存默认关闭；设置 QWEN_IMAGE_CACHE（环境变量或 .env）为目录时启用
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            cache_dir = os.getenv("QWEN_IMAGE_CACHE")
+            _client = QwenClient(image_cache=ImagePayloadCache(cache_dir) if cache_dir else None)
+        return _client
+
+
+def set_client(client: QwenClient) -> None:
+    """替换默认客户端，例如调整限速或指向本地 fake endpoint"""
+    global _client
+    with _client_lock:
+        _client = client
@@ -1,22 +1,27 @@
-import os, tiktoken
+import os, re, time, json5, tiktoken, unicodedata
 from tqdm import tqdm
-from typing import List, Tuple
-from dotenv import load_dotenv
-from dashscope import MultiModalConversation
+from functools import lru_cache
+from typing import List, Optional, Tuple
+from .cache import KVCache, sha256_file, sha256_text
+from .qwen_client import get_client, response_text
 from langchain.docstore.document import Document
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 
 
 
-load_dotenv()
 ENC = tiktoken.get_encoding("o200k_base")
-qwen_key = os.getenv("DASHSCOPE_API_KEY")
-if not qwen_key:
-    raise RuntimeError("请先确保 DASHSCOPE_API_KEY 已正确设置并激活了 mmrag 环境")
+RERANK_MODEL = "qwen2.5-vl-7b-instruct"
+RERANK_PROMPT_VERSION = "v1"        # 修改评分提示词时递增，旧缓存分数自动失效
 
 # ---------- Qwen 调用：单块评分 ----------
 def qwen_score_block(query: str, block: Document) -> float:
     """给父块打相关分（0~1）。若失败返回 0."""
+    score = _score_block(query, block)
+    return 0.0 if score is None else score
+
+
+def _score_block(query: str, block: Document) -> Optional[float]:
+    """qwen_score_block 的实现，失败时返回 None（不写入分数缓存）"""
     t   = block.metadata["type"]
     txt = block.page_content[:2000]      # ⬅️ 如过长截断，确保单块 < 4k tok
     if t in {"image", "table"}:
@@ -41,17 +46,236 @@ def qwen_score_block(query: str, block: Document) -> float:
     ]
 
     try:
-        resp = MultiModalConversation.call(
-            api_key = qwen_key,
-            model   = "qwen2.5-vl-7b-instruct",
-            messages= messages,
+        resp = get_client().call(
+            RERANK_MODEL,
+            messages,
             vl_high_resolution_images=False
         )
-        score_txt = resp["output"]["choices"][0]["message"].content[0]["text"]
+        score_txt = response_text(resp)
         return float(score_txt.strip())
     except Exception as e:
         print("评分失败:", e)
-        return 0.0
+        return None
+
+
+
+# ---------- Qwen 调用：多块打包评分（listwise） ----------
+def _block_content(idx: int, block: Document, max_chars: int) -> List[dict]:
+    """第 idx 个候选块的消息内容：编号 + 类型 +（图像）+ 文本"""
+    t   = block.metadata["type"]
+    txt = block.page_content[:max_chars]
+    typ = t if t in {"image", "table"} else "text"
+    content = [{"text": f"[{idx}] Context ({typ}):"}]
+    img_path = block.metadata.get("img_path")
+    if t == "image" and img_path and os.path.exists(img_path):
+        content.append({"image": img_path})
+    content.append({"text": txt})
+    return content
+
+
+def _first_json(txt: str):
+    """
+    从第一个 [ / { 起按括号配对截出完整的 JSON（跳过字符串内的括号），交给 json5 解析；
+    其后的说明文字（可能也带括号）不会被并入。解析失败则从下一个 [ / { 重试，都不行返回 None
+    """
+    pairs = {"[": "]", "{": "}"}
+    start = 0
+    while True:
+        starts = [i for i in (txt.find("[", start), txt.find("{", start)) if i >= 0]
+        if not starts:
+            return None
+        start = min(starts)
+        stack, quote, esc = [], None, False
+        for j in range(start, len(txt)):
+            ch = txt[j]
+            if quote:
+                if esc:
+                    esc = False
+                elif ch == "\\":
+                    esc = True
+                elif ch == quote:
+                    quote = None
+            elif ch in "\"'":
+                quote = ch
+            elif ch in pairs:
+                stack.append(pairs[ch])
+            elif ch in "]}":
+                if not stack or stack.pop() != ch:
+                    break
+                if not stack:
+                    try:
+                        return json5.loads(txt[start:j + 1])
+                    except Exception:
+                        break
+        start += 1
+
+
+def parse_block_scores(txt: str, n: int) -> List[Optional[float]]:
+    """
+    解析 {"scores": [s1, ...]} / [s1, ...] / {"1": s1, ...}，返回长度 n 的分数表，
+    缺失、越界或无法解析的位置为 None（交给单块评分兜底）
+    """
+    m = re.search(r"```(?:json)?\s*(.*?)\s*```", txt, re.S | re.I)
+    core = m.group(1) if m else txt
+    data = _first_json(core)
+    if isinstance(data, dict) and "scores" in data:
+        data = data["scores"]
+    if isinstance(data, dict):
+        data = [data.get(str(i), data.get(f"[{i}]")) for i in range(1, n + 1)]
+
+    out: List[Optional[float]] = [None] * n
+    if isinstance(data, list):
+        for i, v in enumerate(data[:n]):
+            try:
+                v = float(v)
+            except (TypeError, ValueError):
+                continue
+            if 0.0 <= v <= 1.0:
+                out[i] = v
+    return out
+
+
+def qwen_score_blocks(query: str, blocks: List[Document], max_chars: int = 1500) -> List[float]:
+    """
+    一次请求给多个块（文本 / 图 / 表可混合）打相关分（0~1）。
+    响应无法解析的块逐个回退到 qwen_score_block
+    """
+    return [0.0 if s is None else s for s, _ in _score_blocks(query, blocks, max_chars)]
+
+
+def _score_blocks(query: str, blocks: List[Document],
+                  max_chars: int = 1500) -> List[Tuple[Optional[float], str]]:
+    """
+    返回逐块的 (分数, 评分方式)：listwise 解析成功的为 "list"，回退到单块评分的为 "single"，
+    分数缓存按实际评分方式记键
+    """
+    user_content = [{"text": f"Query: {query}\n\n下面有 {len(blocks)} 个编号的候选内容。"}]
+    for i, blk in enumerate(blocks, 1):
+        user_content.extend(_block_content(i, blk, max_chars))
+    user_content.append({"text":
+        f"请分别给出每个候选内容与 Query 的相关性分数，0~1 间小数。"
+        f"仅回复 JSON：{{\"scores\": [第1个分数, ..., 第{len(blocks)}个分数]}}"})
+
+    messages = [
+        {"role": "system",
+         "content": [{"text": "You are a helpful assistant for relevance scoring."}]},
+        {"role": "user", "content": user_content}
+    ]
+
+    try:
+        resp = get_client().call(
+            RERANK_MODEL,
+            messages,
+            vl_high_resolution_images=False
+        )
+        scores = parse_block_scores(response_text(resp), len(blocks))
+    except Exception as e:
+        print("批量评分失败，逐块重试:", e)
+        scores = [None] * len(blocks)
+
+    return [(s, "list") if s is not None else (_score_block(query, blk), "single")
+            for s, blk in zip(scores, blocks)]
+
+
+
+# ---------- 本地交叉编码器预排序（CPU） ----------
+class CrossEncoderPreRanker():
+    """
+    用本地小型 cross-encoder（如 bge-reranker-base）在 CPU 上给全部候选打分，
+    只把前 budget 个文本块 / 前 media_budget 个图表块交给 VLM 精排
+    """
+    def __init__(self, model_path: str, batch_size: int = 32, max_length: int = 512,
+                 device: str = "cpu", max_chars: int = 2000):
+        self.model_path = model_path
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.device     = device
+        self.max_chars  = max_chars
+        self._model     = None
+
+
+    @property
+    def model(self):
+        if self._model is None:
+            from sentence_transformers import CrossEncoder
+            self._model = CrossEncoder(self.model_path, max_length=self.max_length, device=self.device,
+                                       local_files_only=True)
+        return self._model
+
+
+    def score(self, query: str, blocks: List[Document]) -> List[float]:
+        """按文本长度排序后分批预测（同批长度相近、padding 少），结果按原顺序返回"""
+        texts = [b.page_content[:self.max_chars] for b in blocks]
+        order = sorted(range(len(texts)), key=lambda i: -len(texts[i]))
+        preds = self.model.predict([(query, texts[i]) for i in order], batch_size=self.batch_size,
+                                   show_progress_bar=False) if texts else []
+        scores = [0.0] * len(texts)
+        for i, v in zip(order, preds):
+            scores[i] = float(v)
+        return scores
+
+
+    def prerank(self, query: str, parents: List[Document], budget: int = 40,
+                media_budget: Optional[int] = None) -> List[Document]:
+        """返回预排序后截断的候选：文本块至多 budget 个、图表块至多 media_budget 个（None 时同 budget）"""
+        scores = self.score(query, parents)
+        ranked = sorted(zip(scores, range(len(parents))), key=lambda x: (-x[0], x[1]))
+        caps   = {"text": budget, "media": budget if media_budget is None else media_budget}
+        used, out = {"text": 0, "media": 0}, []
+        for _, i in ranked:
+            kind = "media" if parents[i].metadata["type"] in {"image", "table"} else "text"
+            if used[kind] < caps[kind]:
+                out.append(parents[i])
+                used[kind] += 1
+        return out
+
+
+
+# ---------- rerank 分数缓存 ----------
+def normalize_query(query: str) -> str:
+    """NFKC + 小写 + 空白归一，使同一问题的不同写法命中同一缓存项"""
+    return " ".join(unicodedata.normalize("NFKC", query).lower().split())
+
+
+@lru_cache(maxsize=65536)
+def _image_digest(path: str, mtime: float, size: int) -> str:
+    return sha256_file(path)
+
+
+def block_digest(block: Document) -> str:
+    """块内容哈希：文本 +（图像块）图像文件内容"""
+    h = sha256_text(f'{block.metadata["type"]}\n{block.page_content}')
+    img_path = block.metadata.get("img_path")
+    if block.metadata["type"] == "image" and img_path and os.path.exists(img_path):
+        st = os.stat(img_path)
+        h = sha256_text(h + _image_digest(img_path, st.st_mtime, st.st_size))
+    return h
+
+
+def rerank_key(query: str, block: Document, mode: str) -> str:
+    """键 = 模型 | 提示词版本 | 评分方式(single / list) | 规范化查询哈希 | 块内容哈希"""
+    return "|".join([RERANK_MODEL, RERANK_PROMPT_VERSION, mode,
+                     sha256_text(normalize_query(query))[:32], block_digest(block)[:32]])
+
+
+def cached_scores(score_cache: KVCache, query: str, blocks: List[Document], batch: int) -> dict:
+    """
+    查分数缓存，返回 {id(blk): score}。batch > 1 时先查 "list" 键，未命中再查 "single" 键：
+    batch 的尾组只剩一个块、或 listwise 解析失败回退单块评分时，分数按 "single" 记键
+    """
+    found = {}
+    for mode in (("list", "single") if batch > 1 else ("single",)):
+        keys = {id(blk): rerank_key(query, blk, mode) for blk in blocks if id(blk) not in found}
+        if not keys:
+            break
+        cached = score_cache.get_many(keys.values())
+        found.update((i, cached[k]) for i, k in keys.items() if k in cached)
+    return found
+
+
+def open_rerank_cache(path, max_entries: int = 200_000) -> KVCache:
+    """磁盘 rerank 分数缓存（sqlite，超过 max_entries 按 LRU 淘汰）"""
+    return KVCache(path, max_entries=max_entries)
 
 
 
@@ -62,29 +286,61 @@ def rerank_parents_with_llm(
     n_text: int,  # TOP_TEXT
     n_media: int, # TOP_MEDIA
     batch: int,   # BATCH
+    preranker: Optional[CrossEncoderPreRanker] = None,
+    prerank_budget: int = 40,
+    prerank_media_budget: Optional[int] = None,
+    score_cache: Optional[KVCache] = None,
 ) -> Tuple[List[Document], List[Document]]:
-    """返回 (top_text_parents, top_media_parents)"""
-    # 1) 分类
-    text_blocks  = [p for p in parents if p.metadata["type"] in {"parent","text"}]
-    media_blocks = [p for p in parents if p.metadata["type"] in {"image","table"}]
+    """
+    返回 (top_text_parents, top_media_parents)
+    给定 preranker 时先用本地 cross-encoder 预排序，只有前 prerank_budget 个（图表 prerank_media_budget 个）送入 VLM
+    给定 score_cache（open_rerank_cache）时先查缓存，只对未命中的块发起 VLM 评分
+    """
+    if preranker is not None:
+        n_before = len(parents)
+        parents  = preranker.prerank(query, parents, prerank_budget, prerank_media_budget)
+        print(f"Cross-encoder 预排序：{n_before} → {len(parents)} 个候选送入 VLM 评分")
 
-    # 2) 并行逐块评分
+    # 1) 只保留文本 / 图表父块（按传入顺序）
+    blocks = [p for p in parents if p.metadata["type"] in {"parent","text","image","table"}]
+
+    # 2) 并行评分：每次请求打包 batch 个块（文本 / 图表混合），batch <= 1 时逐块评分
     scored_text  = []
     scored_media = []
+    batch  = max(batch, 1)
+
+    def pack(score, blk):
+        (scored_media if blk.metadata["type"] in {"image", "table"} else scored_text).append((score, blk))
 
-    def score_and_pack(block):
-        s = qwen_score_block(query, block)
-        return (s, block)
+    if score_cache is not None:
+        cached = cached_scores(score_cache, query, blocks, batch)
+        for blk in blocks:
+            if id(blk) in cached:
+                pack(cached[id(blk)], blk)
+        blocks = [blk for blk in blocks if id(blk) not in cached]
+    groups = [blocks[i:i + batch] for i in range(0, len(blocks), batch)]
+    fresh  = []
+
+    def score_and_pack(group):
+        scored = _score_blocks(query, group) if len(group) > 1 else [(_score_block(query, group[0]), "single")]
+        return [(score, mode, blk) for (score, mode), blk in zip(scored, group)]
 
     with ThreadPoolExecutor(max_workers=8) as ex:
-        futures = {
-            ex.submit(score_and_pack, blk): ("text" if blk in text_blocks else "media")
-            for blk in text_blocks + media_blocks
-        }
-        for fut in tqdm(as_completed(futures), total=len(futures), desc="Qwen Scoring"):
-            typ = futures[fut]
-            score, blk = fut.result()
-            (scored_text if typ=="text" else scored_media).append((score, blk))
+        futures = [ex.submit(score_and_pack, g) for g in groups]
+        with tqdm(total=len(blocks), desc="Qwen Scoring") as bar:
+            for fut in as_completed(futures):
+                for score, mode, blk in fut.result():
+                    fresh.append((score, mode, blk))
+                    pack(0.0 if score is None else score, blk)      # 失败按 0 分处理
+                    bar.update(1)
+
+    if score_cache is not None:
+        # 只缓存成功得到的分数（失败的块下次重新评分），键按实际评分方式
+        score_cache.put_many((rerank_key(query, blk, mode), score) for score, mode, blk in fresh
+                             if score is not None)
+        st = score_cache.stats()
+        print(f"Rerank cache: {st['hits']} hits / {st['misses']} misses "
+              f"(hit rate {st['hit_rate']:.1%}, {st['evictions']} evicted)")
 
     # 3) 排序 & 截断
     scored_text.sort(key=lambda x: x[0], reverse=True)
@@ -94,3 +350,125 @@ def rerank_parents_with_llm(
     top_media = [blk for _, blk in scored_media[:n_media]]
 
     return top_text, top_media
+
+
+
+# ---------- 渐进式 rerank（anytime） ----------
+def rerank_parents_progressive(
+    query: str,
+    parents: List[Document],
+    n_text: int,
+    n_media: int,
+    batch: int,
+    deadline: Optional[float] = None,
+    threshold: Optional[float] = None,
+    prior_cutoff: Optional[int] = None,
+    score_cache: Optional[KVCache] = None,
+    max_workers: int = 8,
+) -> Tuple[List[Document], List[Document], bool]:
+    """
+    按 parents 的顺序（即融合排名）逐批评分，随时可停，返回 (top_text, top_media, complete)
+      · threshold    : 某类已有 n 个块得分 >= threshold 时视为已定，不再提交该类的后续块
+      · prior_cutoff : 每类只评分融合排名前 max(prior_cutoff, n) 个块
+      · deadline     : 自调用起的秒数；到期后不再等待，返回已有结果且 complete=False
+    同时在途的请求不超过 max_workers，提前停止时尚未提交的块不会产生调用；
+    同分按融合排名先后。某类已评分的块不足 n 个（如到期前一个都没评完）时，
+    按融合 / 预排序顺序用未评分的块补足，查询不会因此拿不到上下文
+    """
+    t0     = time.monotonic()
+    batch  = max(batch, 1)
+    need   = {"text": n_text, "media": n_media}
+    kind   = lambda blk: "media" if blk.metadata["type"] in {"image", "table"} else "text"
+    blocks = [p for p in parents if p.metadata["type"] in {"parent","text","image","table"}]
+    prior  = {id(blk): r for r, blk in enumerate(blocks)}
+    ranked_by_prior = list(blocks)
+
+    if prior_cutoff is not None:
+        seen, kept = {"text": 0, "media": 0}, []
+        for blk in blocks:
+            if seen[kind(blk)] < max(prior_cutoff, need[kind(blk)]):
+                kept.append(blk)
+            seen[kind(blk)] += 1
+        blocks = kept
+
+    scored = {"text": [], "media": []}
+    def record(score, blk):
+        scored[kind(blk)].append((0.0 if score is None else score, blk))
+
+    if score_cache is not None:
+        cached = cached_scores(score_cache, query, blocks, batch)
+        for blk in blocks:
+            if id(blk) in cached:
+                record(cached[id(blk)], blk)
+        blocks = [blk for blk in blocks if id(blk) not in cached]
+
+    def settled(k: str) -> bool:
+        return threshold is not None and sum(s >= threshold for s, _ in scored[k]) >= need[k]
+
+    queue = list(reversed(blocks))
+    def next_group() -> List[Document]:
+        group = []
+        while queue and len(group) < batch:
+            blk = queue.pop()
+            if not settled(kind(blk)):
+                group.append(blk)
+        return group
+
+    def score_group(group):
+        scored = _score_blocks(query, group) if len(group) > 1 else [(_score_block(query, group[0]), "single")]
+        return [(score, mode, blk) for (score, mode), blk in zip(scored, group)]
+
+    def cache_late(fut):
+        if fut.cancelled() or fut.exception() is not None:
+            return
+        try:
+            score_cache.put_many((rerank_key(query, blk, mode), sc) for sc, mode, blk in fut.result()
+                                 if sc is not None)
+        except Exception as e:                     # 调用方可能已关闭缓存
+            print(f"[Warn] late rerank scores not cached: {e}")
+
+    fresh, pending, complete = [], set(), True
+    ex = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        while True:
+            while len(pending) < max_workers:
+                group = next_group()
+                if not group:
+                    break
+                pending.add(ex.submit(score_group, group))
+            if not pending:
+                break
+            timeout = None if deadline is None else deadline - (time.monotonic() - t0)
+            done, _ = wait(pending, timeout=None if timeout is None else max(timeout, 0.0),
+                           return_when=FIRST_COMPLETED)
+            if not done:
+                complete = False
+                break
+            pending -= done
+            for fut in done:
+                for score, mode, blk in fut.result():
+                    record(score, blk)
+                    fresh.append((score, mode, blk))
+    finally:
+        # 不等待已在途的请求，直接返回当前结果；已付费的迟到分数仍在完成时写入缓存
+        if score_cache is not None:
+            for fut in pending:
+                fut.add_done_callback(cache_late)
+        ex.shutdown(wait=False, cancel_futures=True)
+
+    if score_cache is not None:
+        score_cache.put_many((rerank_key(query, blk, mode), sc) for sc, mode, blk in fresh if sc is not None)
+
+    print(f"Progressive rerank: {len(scored['text']) + len(scored['media'])} scored, "
+          f"{len(fresh)} via VLM, {'complete' if complete else 'deadline hit'} "
+          f"in {time.monotonic() - t0:.1f}s")
+
+    top = {}
+    for k in ("text", "media"):
+        ranked = sorted(scored[k], key=lambda x: (-x[0], prior[id(x[1])]))
+        top[k] = [blk for _, blk in ranked[:need[k]]]
+        if len(top[k]) < need[k]:
+            chosen = {id(blk) for blk in top[k]}
+            top[k] += [blk for blk in ranked_by_prior
+                       if kind(blk) == k and id(blk) not in chosen][:need[k] - len(top[k])]
+    return top["text"], top["media"], complete
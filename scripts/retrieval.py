@@ -1,35 +1,135 @@
+import time, hashlib, threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 from pathlib import Path
 from typing import List, Tuple
-from rank_bm25 import BM25Okapi
-from collections import Counter, defaultdict
+from .bm25 import SparseBM25
+from .sparse_tokenizer import SparseTokenizer, tokenize_corpus
+from .fusion import FUSION_METHODS, fuse_legs
+from .location_index import LocationIndex
+from .vector_index import index_config, open_vector_index, update_vector_index, ann_recall
+from collections import Counter
 from langchain.docstore.document import Document
-from langchain_community.vectorstores import FAISS
-from langchain_community.embeddings import HuggingFaceEmbeddings
+from .embedding import CachedEmbeddings
+
+
+
+SPARSE_CHUNK = 32       # 稀疏一路每打分这么多查询检查一次是否已超时被放弃
+
+
+class _LegCancelled(Exception):
+    """超时被放弃的一路在检查点提前退出，尽快让出线程池中的线程"""
 
 
 class Retriever():
-    def __init__(self, children, parents, configs):
+    def __init__(self, children, parents, configs, docs=None):
         # building FAISS vector bases
         self.configs = configs
         self.children = children
         self.parents  = parents
-        embeddings = HuggingFaceEmbeddings(
+        self.parent_by_id   = {p.metadata["parent_id"]: p for p in parents}
+        self.child_by_chunk = {c.metadata["chunk_id"]: c for c in children}
+        # 按 token 长度分批 + 多进程 CPU 编码；EMBED_CACHE 下按内容哈希复用已算过的向量
+        embeddings = CachedEmbeddings(
             model_name      = configs["DENSE_MODEL"],
-            model_kwargs    = {"local_files_only": True} 
+            cache_dir       = configs.get("EMBED_CACHE"),
+            batch_size      = configs.get("EMBED_BATCH", 32),
+            workers         = configs.get("EMBED_WORKERS", 1),
+            model_kwargs    = {"local_files_only": True}
         )
+        self.embeddings = embeddings
     
+        # 按 manifest 校验 / 增量同步已有索引，模型变化时才全量重建
+        # INDEX_TYPE = flat(默认) / ivf / hnsw / ivfpq / sq / ivfsq，非 flat 时以 mmap 只读打开
         INDEX_DIR = Path(configs["INDEX_PATH"])      #Path("faiss_index") 
-        if INDEX_DIR.exists():
-            vectordb = FAISS.load_local(str(INDEX_DIR), embeddings)
-        else:
-            vectordb = FAISS.from_documents(children, embeddings)
-            vectordb.save_local(str(INDEX_DIR))
+        self.index_cfg = index_config(configs)
+        vectordb  = open_vector_index(children, embeddings, INDEX_DIR, configs["DENSE_MODEL"], self.index_cfg)
 
+        self.vectordb = vectordb
         self.dense_retriever = vectordb.as_retriever(search_kwargs={"k": configs["DENSE_PICK"]})
 
         #---------------------------------------------------------
-        corpus_tokens = [c.page_content.split() for c in children]
-        self.bm25 = BM25Okapi(corpus_tokens)
+        # 稀疏检索分词器：whitespace(默认) / ngram / jieba
+        self.tokenizer = SparseTokenizer(
+            mode      = configs.get("SPARSE_TOKENIZER", "whitespace"),
+            ngram     = configs.get("SPARSE_NGRAM", 2),
+            user_dict = configs.get("SPARSE_USER_DICT"),
+        )
+        self._build_sparse()
+
+        # 稠密 / 稀疏两路并发执行（FAISS、numpy、torch 计算期间都会释放 GIL）；
+        # 每个并发查询占 2 个线程，默认 8 个线程可同时服务 4 个查询
+        self.leg_pool = ThreadPoolExecutor(max_workers=configs.get("RETRIEVAL_WORKERS", 8))
+
+        # 原始条目 (book, page) → type → 下标，供同页公式 / 邻页上下文查询
+        self.loc_index = LocationIndex(docs) if docs is not None else None
+
+
+    def sparse_fingerprint(self) -> str:
+        """子块集合（有序 chunk_id，内容派生）+ 分词器签名的指纹，判断持久化的 BM25 能否复用"""
+        h = hashlib.sha256(self.tokenizer.signature.encode("utf-8"))
+        for c in self.children:
+            h.update(str(c.metadata["chunk_id"]).encode("utf-8"))
+            h.update(b"\n")
+        return h.hexdigest()
+
+
+    def _build_sparse(self) -> None:
+        """
+        BM25 倒排索引 + 「父块为文本」的子块掩码（供 bm25_retrieve_text_parents 过滤）
+        索引持久化在 SPARSE_INDEX_PATH（默认 INDEX_PATH/bm25），指纹一致时直接 mmap 读取
+        """
+        sparse_dir = Path(self.configs.get("SPARSE_INDEX_PATH") or Path(self.configs["INDEX_PATH"]) / "bm25")
+        fp = self.sparse_fingerprint()
+        self.bm25 = SparseBM25.load(sparse_dir, fp)
+        if self.bm25 is None:
+            corpus_tokens = tokenize_corpus((c.page_content for c in self.children),
+                                            self.tokenizer, self.configs.get("TOKEN_CACHE"))
+            self.bm25 = SparseBM25(corpus_tokens)
+            self.bm25.save(sparse_dir, fp)
+        else:
+            print(f"Loaded BM25 index from {sparse_dir}")
+        self.text_child_mask = np.array(
+            [self.parent_by_id[c.metadata["parent_id"]].metadata["type"] == "parent" for c in self.children],
+            dtype=bool)
+
+
+    def apply_delta(
+        self,
+        children: List[Document],
+        parents: List[Document],
+        docs=None
+    ) -> None:
+        """
+        接收 TextSplitter.split_delta 之后的完整 children / parents：新增与删除由 children 对比索引 manifest
+        得出（见 update_vector_index），只对新增子块做 embedding 并插入 FAISS，删除已移除子块的向量，
+        然后刷新 children / parents / BM25 并保存索引
+        """
+        INDEX_DIR = Path(self.configs["INDEX_PATH"])
+        self.vectordb, n_add, n_del = update_vector_index(self.vectordb, children, self.embeddings, INDEX_DIR,
+                                                          self.configs["DENSE_MODEL"], self.index_cfg)
+        self.dense_retriever = self.vectordb.as_retriever(search_kwargs={"k": self.configs["DENSE_PICK"]})
+
+        self.children = children
+        self.parents  = parents
+        self.parent_by_id   = {p.metadata["parent_id"]: p for p in parents}
+        self.child_by_chunk = {c.metadata["chunk_id"]: c for c in children}
+        self._build_sparse()
+        if docs is not None:
+            self.loc_index = LocationIndex(docs)
+        print(f"Index delta applied: +{n_add} / -{n_del} child chunks")
+
+
+    def ann_recall(self, queries: List[str], k: int = None, sample_size: int = None) -> dict:
+        """
+        当前 ANN 索引相对精确检索的 recall@k（默认 k = DENSE_PICK）与每查询耗时；
+        sample_size 给定时只在随机抽取的子块样本上重新 embedding 作基准（见 vector_index.ann_recall）
+        """
+        report = ann_recall(self.vectordb, self.embeddings, queries, k or self.configs["DENSE_PICK"],
+                            sample_size=sample_size)
+        print(f"{report['index']} recall@{report['k']} = {report['recall']:.4f} "
+              f"({report['ann_ms']:.2f} ms vs exact {report['exact_ms']:.2f} ms / query)")
+        return report
 
 
     def bm25_retrieve_parents(self, query: str) -> Tuple[List[Document], List[Document]]:
@@ -38,10 +138,9 @@ class Retriever():
             child_hits:  Document of the top-bm25_k child chunks with BM25 scores
             parent_hits: Document of the top_parent parent chunks (after deduplication)
         """
-        # child score
-        scores = self.bm25.get_scores(query.split())
-        top_idx = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)[:self.configs["BM25_PICK"]]
-        child_hits = [self.children[i] for i in top_idx]
+        # child score：只对查询词的 postings 打分，部分选择 top-k
+        top_idx, _ = self.bm25.top_k(self.tokenizer(query), self.configs["BM25_PICK"])
+        child_hits = [self.children[int(i)] for i in top_idx]
 
         # mapped to parents
         parent_ids = []
@@ -53,31 +152,58 @@ class Retriever():
                 seen.add(pid)
             if len(parent_ids) >= self.configs["TOP_PARENT"]:
                 break
-        parent_hits = [self.parents[i] for i in parent_ids]
+        parent_hits = [self.parent_by_id[i] for i in parent_ids]
         return child_hits, parent_hits
 
 
     def bm25_retrieve_text_parents(self, query: str):
+        child_hits, _ = self._sparse_search([query])[0]
+        return child_hits, self._parents_of(child_hits)
 
-        scores = self.bm25.get_scores(query.split())
-        idx_sorted = sorted(range(len(scores)),
-                            key=lambda i: scores[i], reverse=True)
 
-        # filterring
-        child_hits, parent_ids = [], []
-        for i in idx_sorted:
-            if len(child_hits) >= self.configs["k_child"]:
-                break
-            pid = self.children[i].metadata["parent_id"]
-            if self.parents[pid].metadata["type"] != "parent":
-                continue                           # skip media child chunks
-            child_hits.append(self.children[i])
-            parent_ids.append(pid)
-            if len(set(parent_ids)) >= self.configs["k_parent"]:   # early stop
-                break
+    def _parents_of(self, child_hits: List[Document]) -> List[Document]:
+        """子块 → 去重后的父块（保持首次出现顺序）"""
+        return [self.parent_by_id[i] for i in dict.fromkeys(c.metadata["parent_id"] for c in child_hits)]
 
-        parent_hits = [self.parents[i] for i in set(parent_ids)]
-        return child_hits, parent_hits
+
+    def _sparse_search(self, queries: List[str], cancel: threading.Event = None) -> List[Tuple[List[Document], np.ndarray]]:
+        """
+        稀疏一路：逐查询返回 (child_hits, bm25 分数)，映射到 k_parent 个不同父块即停止
+        filterring：media 子块由掩码排除，只需取前 k_child 个文本子块
+        cancel 被置位（该路已超时）时在下一个 SPARSE_CHUNK 边界退出
+        """
+        results = []
+        for i in range(0, len(queries), SPARSE_CHUNK):
+            if cancel is not None and cancel.is_set():
+                raise _LegCancelled()
+            results.extend(self.bm25.top_k_batch([self.tokenizer(q) for q in queries[i:i + SPARSE_CHUNK]],
+                                                 self.configs["k_child"], mask=self.text_child_mask))
+        out = []
+        for idx_sorted, scores in results:
+            child_hits, parent_ids = [], set()
+            for i in idx_sorted:
+                child = self.children[int(i)]
+                child_hits.append(child)
+                parent_ids.add(child.metadata["parent_id"])
+                if len(parent_ids) >= self.configs["k_parent"]:   # early stop
+                    break
+            out.append((child_hits, scores[:len(child_hits)]))
+        return out
+
+
+    def _dense_search(self, query_vectors: np.ndarray) -> List[Tuple[List[Document], np.ndarray]]:
+        """
+        稠密一路：一次矩阵 FAISS 检索，逐查询返回 (DENSE_PICK 个子块, 相似度 = -L2 距离)，
+        子块与 dense_retriever.get_relevant_documents 的结果相同
+        """
+        D, I = self.vectordb.index.search(np.asarray(query_vectors, dtype=np.float32), self.configs["DENSE_PICK"])
+        out = []
+        for dist, row in zip(D, I):
+            keep = row != -1
+            hits = [self.vectordb.docstore.search(self.vectordb.index_to_docstore_id[int(i)]) for i in row[keep]]
+            # 以当前 children 中的 parent_id 为准（增量更新后向量库里存的 metadata 可能已过期）
+            out.append(([self.child_by_chunk.get(c.metadata["chunk_id"], c) for c in hits], -dist[keep]))
+        return out
 
 
     def merge_parents(
@@ -99,61 +225,159 @@ class Retriever():
                 merged.append(p)
                 seen.add(key)
         return merged
+
+
+    def fuse_parents(self, dense, sparse) -> List[Tuple[Document, float]]:
+        """
+        按 configs["FUSION"] 融合两路：rrf(默认) / norm / merge(旧的 dense 在前、按页去重拼接)
+        权重 DENSE_WEIGHT / SPARSE_WEIGHT，RRF 常数 RRF_K；返回 [(父块, 融合分)]，分数降序
+        """
+        method = self.configs.get("FUSION", "rrf")
+        if method not in FUSION_METHODS:
+            raise ValueError(f"未知融合方式: {method!r}（可选 {sorted(FUSION_METHODS)}）")
+        if method == "merge":
+            merged = self.merge_parents(self._parents_of(dense[0]), self._parents_of(sparse[0]))
+            return [(p, 0.0) for p in merged]
+        fused = fuse_legs([(dense[0],  dense[1],  self.configs.get("DENSE_WEIGHT", 1.0)),
+                           (sparse[0], sparse[1], self.configs.get("SPARSE_WEIGHT", 1.0))],
+                          method, self.configs.get("RRF_K", 60))
+        return [(self.parent_by_id[pid], score) for pid, score in fused]
+
+
+    def apply_budget(self, parents: List[Document]) -> List[Document]:
+        """
+        送入 rerank 前截断：文本父块最多 RERANK_BUDGET 个、图表父块最多 MEDIA_BUDGET 个（None 为不限），
+        保持融合顺序
+        """
+        caps = {"text": self.configs.get("RERANK_BUDGET"), "media": self.configs.get("MEDIA_BUDGET")}
+        used = Counter()
+        out  = []
+        for p in parents:
+            kind = "media" if p.metadata["type"] in {"image", "table"} else "text"
+            if caps[kind] is None or used[kind] < caps[kind]:
+                out.append(p)
+                used[kind] += 1
+        return out
         
 
-    def hybrid_retrieval(self, query: str):
-        # dense retrival
-        dense_child_hits = self.dense_retriever.get_relevant_documents(query)
-        dense_parent_ids = {c.metadata["parent_id"] for c in dense_child_hits}
-        dense_parents    = [self.parents[i] for i in dense_parent_ids]
-        dense_counter    = Counter(d.metadata["type"] for d in dense_parents)
-
-        print(
-            f"稠密检索到 {len(dense_child_hits)} 个子块，映射到 {len(dense_parents)} 个父块，"
-            f"包含 {dense_counter.get('parent',0)+dense_counter.get('text',0)} 段文本，"
-            f"{dense_counter.get('image',0)} 张图像，"
-            f"{dense_counter.get('table',0)} 个表格，"
-            # f"{dense_counter.get('equation',0)} 个公式"
-        )
+    def _dense_leg(self, queries: List[str], cancel: threading.Event = None) -> List[List[Document]]:
+        vectors = self.embeddings.embed_queries(queries)
+        if cancel is not None and cancel.is_set():        # 编码期间已超时：不再检索
+            raise _LegCancelled()
+        return self._dense_search(vectors)
 
-        # sparse retrival
-        sparse_child_hits, sparse_parents = self.bm25_retrieve_text_parents(query)
-        sparse_counter = Counter(d.metadata["type"] for d in sparse_parents)
 
-        print(
-            f"稀疏检索到 {len(sparse_child_hits)} 个子块，映射到 {len(sparse_parents)} 个父块，"
-            f"包含 {sparse_counter.get('parent',0)+sparse_counter.get('text',0)} 段文本，"
-            f"{sparse_counter.get('image',0)} 张图像，"
-            f"{sparse_counter.get('table',0)} 个表格，"
-            # f"{sparse_counter.get('equation',0)} 个公式"
-        )
+    @staticmethod
+    def _timed_leg(leg, queries: List[str], cancel: threading.Event):
+        t = time.perf_counter()
+        return leg(queries, cancel), 1000 * (time.perf_counter() - t)
+
+
+    def _run_legs(self, queries: List[str], dense_timeout=None, sparse_timeout=None):
+        """
+        两路并发；各自的时间预算（秒，None 为不限）从提交时起算，超时或出错的一路返回空结果。
+        返回 (dense, sparse, status)，status = {"dense": ok/timeout/error, "sparse": ..., "*_ms": 成功一路的耗时}
+        超时的一路被取消：尚未开始的直接撤销，已在运行的在下一个检查点退出并让出线程
+        """
+        t0     = time.perf_counter()
+        cancel = {"dense": threading.Event(), "sparse": threading.Event()}
+        futs   = {"dense":  self.leg_pool.submit(self._timed_leg, self._dense_leg, queries, cancel["dense"]),
+                  "sparse": self.leg_pool.submit(self._timed_leg, self._sparse_search, queries, cancel["sparse"])}
+        budget = {"dense": dense_timeout, "sparse": sparse_timeout}
+        empty  = {leg: [([], np.empty(0)) for _ in queries] for leg in futs}
+        out, status = {}, {}
+        for leg, fut in futs.items():
+            remaining = None if budget[leg] is None else max(0.0, t0 + budget[leg] - time.perf_counter())
+            try:
+                out[leg], status[f"{leg}_ms"] = fut.result(timeout=remaining)
+                status[leg] = "ok"
+            except FutureTimeout:
+                cancel[leg].set()
+                fut.cancel()
+                out[leg], status[leg] = empty[leg], "timeout"
+                print(f"[Warn] {leg} retrieval exceeded {budget[leg]}s, returning partial results")
+            except Exception as e:
+                out[leg], status[leg] = empty[leg], "error"
+                print(f"[Warn] {leg} retrieval failed: {e!r}")
+        return out["dense"], out["sparse"], status
+
+
+    def hybrid_retrieval(self, query: str, return_status: bool = False):
+        """
+        稠密 / 稀疏并发，DENSE_TIMEOUT / SPARSE_TIMEOUT 为各路的时间预算；
+        return_status=True 时返回 (父块列表, 各路状态)
+        """
+        dense, sparse, status = self._run_legs([query], self.configs.get("DENSE_TIMEOUT"),
+                                               self.configs.get("SPARSE_TIMEOUT"))
+        results = self._merge_legs(dense[0], sparse[0], verbose=True)
+        return (results, status) if return_status else results
+
+
+    def hybrid_retrieval_batch(self, queries: List[str], batch_size: int = 256,
+                               return_status: bool = False) -> List[List[Document]]:
+        """
+        批量混合检索：每 batch_size 个查询做一次 embedding 前向、一次矩阵 FAISS 检索、一次稀疏打分，
+        逐查询结果与 hybrid_retrieval 相同；return_status=True 时另返回逐查询的（所在批次的）各路状态
+        """
+        results, statuses = [], []
+        for i in range(0, len(queries), batch_size):
+            part   = list(queries[i:i + batch_size])
+            dense, sparse, status = self._run_legs(part)
+            results.extend(self._merge_legs(d, sp) for d, sp in zip(dense, sparse))
+            statuses.extend([status] * len(part))
+        return (results, statuses) if return_status else results
+
+
+    def _merge_legs(self, dense, sparse, verbose: bool = False) -> List[Document]:
+        """两路 (child_hits, scores) → 融合排序并按预算截断的父块列表"""
+        fused   = self.fuse_parents(dense, sparse)
+        results = self.apply_budget([p for p, _ in fused])
+
+        if verbose:
+            dense_child_hits,  sparse_child_hits = dense[0], sparse[0]
+            dense_parents,     sparse_parents    = self._parents_of(dense[0]), self._parents_of(sparse[0])
+            dense_counter  = Counter(d.metadata["type"] for d in dense_parents)
+            sparse_counter = Counter(d.metadata["type"] for d in sparse_parents)
+            print(
+                f"稠密检索到 {len(dense_child_hits)} 个子块，映射到 {len(dense_parents)} 个父块，"
+                f"包含 {dense_counter.get('parent',0)+dense_counter.get('text',0)} 段文本，"
+                f"{dense_counter.get('image',0)} 张图像，"
+                f"{dense_counter.get('table',0)} 个表格，"
+                # f"{dense_counter.get('equation',0)} 个公式"
+            )
+            print(
+                f"稀疏检索到 {len(sparse_child_hits)} 个子块，映射到 {len(sparse_parents)} 个父块，"
+                f"包含 {sparse_counter.get('parent',0)+sparse_counter.get('text',0)} 段文本，"
+                f"{sparse_counter.get('image',0)} 张图像，"
+                f"{sparse_counter.get('table',0)} 个表格，"
+                # f"{sparse_counter.get('equation',0)} 个公式"
+            )
+            print(f"融合({self.configs.get('FUSION', 'rrf')})得到 {len(fused)} 个父块，预算截断后送入 rerank {len(results)} 个")
 
-        results = self.merge_parents(dense_parents, sparse_parents)
-        
         return results
         
 
-    def related_equs(self, top_text_parents, docs):
-        pages_of_text = {
+    def location_index(self, docs=None) -> LocationIndex:
+        """返回与 docs 对应的位置索引；传入新的 docs 对象时重建一次并缓存"""
+        if docs is not None and (self.loc_index is None or self.loc_index.docs is not docs):
+            self.loc_index = LocationIndex(docs)
+        if self.loc_index is None:
+            raise ValueError("位置索引尚未建立：请在 Retriever(..., docs=docs) 或首次调用时传入 docs")
+        return self.loc_index
+
+
+    def related_equs(self, top_text_parents, docs=None, window: int = 0):
+        """
+        top_text_parents 所在页（及 ±window 页）上的全部 equation，按父块顺序去重
+        docs = load_corpus() 得来的四类原始条目（list 或 DocStore），只在首次 / 变化时建索引
+        """
+        loc = self.location_index(docs)
+        pages_of_text = dict.fromkeys(
             (p.metadata["book_idx"], p.metadata["page_idx"])
             for p in top_text_parents
-        }
-
-        eq_by_loc = defaultdict(list)          # key = (book,page) → list[Document]
-        for d in docs:                         # docs = load_corpus() 得来的四类原始条目
-            if d.metadata["type"] == "equation":
-                key = (d.metadata["book_idx"], d.metadata["page_idx"])
-                eq_by_loc[key].append(d)
-
-        # 把这些页里的所有 equation 拉进来
-        top_equations = []
-        seen_eq_ids   = set()            # 防止同页同式重复
-        for loc in pages_of_text:
-            for eq in eq_by_loc.get(loc, []):
-                # 你如果给 equation 生成过唯一 id，可在这里去重
-                if id(eq) not in seen_eq_ids:
-                    top_equations.append(eq)
-                    seen_eq_ids.add(id(eq))
+        )
+        # 把这些页里的所有 equation 拉进来（同一条目只取一次）
+        top_equations = loc.documents(loc.lookup(pages_of_text, types={"equation"}, window=window))
 
         print(f"\n关联到同页公式 {len(top_equations)} 条")
         self.preview_equations(top_equations)
@@ -161,6 +385,13 @@ class Retriever():
         return top_equations
 
 
+    def page_context(self, parents, window: int = 1, types=None, docs=None) -> List[Document]:
+        """parents 所在页 ±window 页上（指定类型）的原始条目，供补充邻页上下文"""
+        loc = self.location_index(docs)
+        pages = dict.fromkeys((p.metadata["book_idx"], p.metadata["page_idx"]) for p in parents)
+        return loc.documents(loc.lookup(pages, types=types, window=window))
+
+
     def preview_equations(self, eq_list, n=3):
         for i, d in enumerate(eq_list[:n], 1):
             latex = (d.page_content[:100] + "…") if len(d.page_content) > 100 else d.page_content
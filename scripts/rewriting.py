@@ -1,15 +1,12 @@
-import os, json5, re, textwrap
+import json5, re, textwrap
 from typing import List, Tuple
 from .prompts import REWRITE_PROMPT
-from dashscope import MultiModalConversation
+from .qwen_client import get_client
 from langchain.docstore.document import Document
 
 
-# 初始化captioner
-qwen_key = os.getenv("DASHSCOPE_API_KEY")
-if not qwen_key:
-    raise RuntimeError("请先确保 DASHSCOPE_API_KEY 已正确设置并激活了 mmrag 环境")
-    
+REWRITE_MODEL = "qwen2.5-vl-72b-instruct"
+
 
 def build_media_inputs(media_docs: List[Document],
                        max_n: int = 5) -> Tuple[List[str], str]:
@@ -99,16 +96,14 @@ def rewrite_with_mllm(answer_text: str,
          "content": user_content}
     ]
 
-    # ---------- 3. 调用 Dashscope MultiModalConversation ----------
-    resp = MultiModalConversation.call(
-        api_key = qwen_key,
-        model   = "qwen2.5-vl-72b-instruct",
-        messages= messages,
+    # ---------- 3. 经共享 QwenClient 调用 Dashscope MultiModalConversation ----------
+    raw_txt = get_client().call_text(
+        REWRITE_MODEL,
+        messages,
         vl_high_resolution_images = False
     )
 
     # ---------- 4. 解析返回 JSON ----------
-    raw_txt = resp["output"]["choices"][0]["message"].content[0]["text"]
     result  = safe_json_load(raw_txt)
     return result
 
@@ -0,0 +1,92 @@
+"""
+稀疏检索（BM25）的可插拔分词器：
+  · whitespace : 原先的 str.split()，中文整句会变成一个 token
+  · ngram      : CJK 字符 n-gram（默认二元，单字成段时保留单字）+ 英文/数字词
+  · jieba      : 词典分词（jieba.lcut_for_search），需额外安装 jieba
+分词结果可按 (分词器签名, 文本哈希) 缓存到磁盘，重建索引时不必重新切分语料
+"""
+import re
+from typing import Iterable, List, Optional
+from .cache import KVCache, sha256_text
+
+
+
+_CJK   = r"㐀-䶿一-鿿豈-﫿぀-ヿ가-힯"
+_TOKEN = re.compile(rf"[{_CJK}]+|[^\W{_CJK}]+", re.UNICODE)
+_IS_CJK = re.compile(rf"[{_CJK}]")
+
+
+class SparseTokenizer():
+    def __init__(self, mode: str = "whitespace", ngram: int = 2, lowercase: bool = True,
+                 user_dict: Optional[str] = None):
+        if mode not in {"whitespace", "ngram", "jieba"}:
+            raise ValueError(f"未知分词模式: {mode!r}")
+        self.mode      = mode
+        self.ngram     = ngram
+        self.lowercase = lowercase
+        self.user_dict = user_dict
+        self._jieba    = None
+        if mode == "jieba":
+            try:
+                import jieba
+            except ImportError as e:
+                raise ImportError("SPARSE_TOKENIZER='jieba' 需要先 pip install jieba") from e
+            if user_dict:
+                jieba.load_userdict(user_dict)
+            self._jieba = jieba
+
+
+    @property
+    def signature(self) -> str:
+        """分词配置的唯一标识，作为缓存键 / 索引指纹的一部分"""
+        sig = f"{self.mode}:n={self.ngram}:lower={int(self.lowercase)}"
+        if self.mode == "jieba" and self.user_dict:
+            sig += f":dict={self.user_dict}"
+        return sig
+
+
+    def __call__(self, text: str) -> List[str]:
+        if self.mode == "whitespace":
+            return text.split()
+        if self.lowercase:
+            text = text.lower()
+        if self.mode == "jieba":
+            return [t for t in self._jieba.lcut_for_search(text) if t.strip()]
+
+        tokens = []
+        for run in _TOKEN.findall(text):
+            if not _IS_CJK.match(run):
+                tokens.append(run)
+            elif len(run) <= self.ngram:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + self.ngram] for i in range(len(run) - self.ngram + 1))
+        return tokens
+
+
+
+def tokenize_corpus(texts: Iterable[str], tokenizer: SparseTokenizer,
+                    cache_path: Optional[str] = None, batch: int = 10000) -> List[List[str]]:
+    """
+    批量分词；给定 cache_path 时按 (tokenizer.signature, 文本 sha256) 读写 sqlite 缓存，
+    只对未命中的文本重新分词
+    """
+    texts = list(texts)
+    if not cache_path:
+        return [tokenizer(t) for t in texts]
+
+    cache = KVCache(cache_path)
+    out: List[List[str]] = []
+    for i in range(0, len(texts), batch):
+        part = texts[i:i + batch]
+        keys = [f"{tokenizer.signature}:{sha256_text(t)}" for t in part]
+        found = cache.get_many(keys)
+        fresh = {k: tokenizer(t) for k, t in zip(keys, part) if k not in found}
+        if fresh:
+            cache.put_many(fresh.items())
+            found.update(fresh)
+        out.extend(found[k] for k in keys)
+    st = cache.stats()
+    print(f"Token cache: {st['hits']} hits / {st['misses']} misses")
+    cache.close()
+    return out
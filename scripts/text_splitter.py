@@ -1,39 +1,142 @@
-import json
+import json, hashlib
 import tiktoken
-from collections import defaultdict
+from pathlib import Path
+from functools import lru_cache
+from collections import defaultdict, Counter
 from typing import List, Dict, Tuple
+from concurrent.futures import ProcessPoolExecutor
 from langchain.docstore.document import Document
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from .cache import atomic_dir
+from .doc_store import DocStore, write_doc_store
+
+
+
+@lru_cache(maxsize=None)
+def get_encoder(encoding_name: str = "o200k_base"):
+    """每个进程只构造一次 tiktoken encoder"""
+    return tiktoken.get_encoding(encoding_name)
+
+
+def _snap(buf: bytes, pos: int) -> int:
+    """把字节位置回退到 UTF-8 字符起点，避免窗口边界切开多字节字符"""
+    while 0 < pos < len(buf) and (buf[pos] & 0xC0) == 0x80:
+        pos -= 1
+    return pos
+
+
+def _token_windows(token_bytes: List[bytes], chunk_size: int, chunk_overlap: int) -> List[Tuple[str, int]]:
+    """
+    在一页的 token 序列上按 chunk_size / chunk_overlap 滑窗，
+    返回 [(chunk_text, n_tokens)]；页面只编码一次，窗口文本直接由 token 字节切出
+    """
+    n = len(token_bytes)
+    if n == 0:
+        return []
+    buf = b"".join(token_bytes)
+    offsets = [0]
+    for tb in token_bytes:
+        offsets.append(offsets[-1] + len(tb))
+
+    out, step = [], chunk_size - chunk_overlap
+    for s in range(0, n, step):
+        e = min(s + chunk_size, n)
+        text = buf[_snap(buf, offsets[s]):_snap(buf, offsets[e])].decode("utf-8", errors="replace").strip()
+        if text:
+            out.append((text, e - s))
+        if e == n:
+            break
+    return out
+
+
+def _split_page_batch(texts: List[str], chunk_size: int, chunk_overlap: int,
+                      encoding_name: str) -> List[List[Tuple[str, int]]]:
+    """进程池 worker：批量编码一组页面并切窗"""
+    enc = get_encoder(encoding_name)
+    return [
+        _token_windows(enc.decode_tokens_bytes(tokens), chunk_size, chunk_overlap)
+        for tokens in enc.encode_ordinary_batch(texts)
+    ]
+
+
+
+def stable_id(*parts) -> str:
+    """由内容与位置派生的稳定 id（与 docs 的排列顺序无关）"""
+    h = hashlib.sha1()
+    for p in parts:
+        h.update(str(p).encode("utf-8"))
+        h.update(b"\x1f")
+    return h.hexdigest()[:16]
+
+
+def docs_fingerprint(docs, **split_params) -> str:
+    """docs 内容 + 切块参数的指纹，用于判断持久化的切块结果能否复用"""
+    h = hashlib.sha256(json.dumps(split_params, sort_keys=True).encode("utf-8"))
+    for d in docs:
+        h.update(d.page_content.encode("utf-8"))
+        h.update(json.dumps(d.metadata, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+    return h.hexdigest()
+
+
+
+def save_chunks(parents, children, path, fingerprint: str = "") -> None:
+    """
+    parents / children 各存为一个 DocStore，并记录指纹。
+    整个目录在临时目录中写好（指纹最后写）后再换入 path，已打开的旧 DocStore 仍可读
+    """
+    with atomic_dir(path) as tmp:
+        write_doc_store(parents,  tmp / "parents")
+        write_doc_store(children, tmp / "children")
+        with open(tmp / "chunks.json", "w", encoding="utf-8") as f:
+            json.dump({"fingerprint": fingerprint, "n_parents": len(parents),
+                       "n_children": len(children)}, f)
+
+
+def load_chunks(path, fingerprint: str = None):
+    """
+    读取 save_chunks 的结果，返回 (parents, children) 两个 mmap DocStore；
+    给定 fingerprint 且不匹配（或不存在）时返回 None
+    """
+    path = Path(path)
+    if not (path / "chunks.json").exists():
+        return None
+    with open(path / "chunks.json", encoding="utf-8") as f:
+        info = json.load(f)
+    if fingerprint is not None and info["fingerprint"] != fingerprint:
+        return None
+    return DocStore(path / "parents"), DocStore(path / "children")
+
+
 
 class TextSplitter():
     def count_tokens(self, text: str, encoding_name: str = "o200k_base") -> int:
-        enc = tiktoken.get_encoding(encoding_name)
-        return len(enc.encode(text))
+        return len(get_encoder(encoding_name).encode_ordinary(text))
+
 
-    
     def split_docs(
         self,
         docs: List[Document],
         chunk_size: int = 300,
-        chunk_overlap: int = 50
+        chunk_overlap: int = 50,
+        workers: int = 1,
+        batch_pages: int = 256,
+        encoding_name: str = "o200k_base"
     ) -> Tuple[List[Document], List[Document]]:
         """
         返回 (parents, children)
           parents  : 供 LLM 使用的父块（page 级文本 + image/table 原文）
           children : 供稠密/稀疏检索的子块（text/equation 滑窗 + image/table 自身）
+        每页只编码一次，直接在 token 窗口上切块；workers > 1 时按页批次分发到进程池，
+        结果按批次顺序合并，输出与 workers 数无关
         """
+        if not 0 <= chunk_overlap < chunk_size:
+            raise ValueError("需要 0 <= chunk_overlap < chunk_size")
+        enc = get_encoder(encoding_name)
         page_text: Dict[Tuple[int, int], List[str]] = defaultdict(list)
-    
+
         parents:  List[Document] = []
         children: List[Document] = []
-        chunk_id = 0
-
-        splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
-            model_name   = "gpt-4o",
-            chunk_size   = chunk_size,
-            chunk_overlap= chunk_overlap
-        )
 
+        media = []
         for d in docs:
             dtype = d.metadata["type"]
 
@@ -42,35 +145,58 @@ class TextSplitter():
                 page_text[key].append(d.page_content.strip())
 
             elif dtype in {"image", "table"}:
-                p_idx = len(parents)                
-                parents.append(d)                   
+                media.append(d)
 
-                children.append(
-                    Document(
-                        page_content=d.page_content,
-                        metadata={
-                            **d.metadata,           
-                            "type":      "child",
-                            "parent_id": p_idx,
-                            "chunk_id":  chunk_id,
-                            "length_tokens": self.count_tokens(d.page_content)
-                        }
-                    )
+        # parent_id / chunk_id 由 (book_idx, page_idx, type, 内容) 派生，完全相同的重复块再以出现序号区分
+        occurrence = Counter()
+        def parent_id_of(book, page, dtype, content):
+            key = (book, page, dtype, content)
+            occurrence[key] += 1
+            return stable_id(*key, occurrence[key])
+
+        # image / table：父块即原 Document（补上 parent_id），子块只需 token 数（批量编码）
+        media_tokens = enc.encode_ordinary_batch([d.page_content for d in media]) if media else []
+        for d, tokens in zip(media, media_tokens):
+            book, page = d.metadata.get("book_idx", -1), d.metadata.get("page_idx", -1)
+            p_id = parent_id_of(book, page, d.metadata["type"], d.page_content)
+            parents.append(Document(page_content=d.page_content,
+                                    metadata={**d.metadata, "parent_id": p_id}))
+
+            children.append(
+                Document(
+                    page_content=d.page_content,
+                    metadata={
+                        **d.metadata,
+                        "type":      "child",
+                        "parent_id": p_id,
+                        "chunk_id":  stable_id(p_id, 0),
+                        "length_tokens": len(tokens)
+                    }
                 )
-                chunk_id += 1
+            )
 
-        for (book, page), pieces in page_text.items():
-            parent_text = " ".join(pieces).strip()
+        # text / equation：按页拼成父块，再在 token 窗口上切子块
+        pages = [(key, " ".join(pieces).strip()) for key, pieces in page_text.items()]
+        batches = [[t for _, t in pages[i:i + batch_pages]] for i in range(0, len(pages), batch_pages)]
+        args = (chunk_size, chunk_overlap, encoding_name)
+        if workers > 1 and len(batches) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as ex:
+                results = ex.map(_split_page_batch, batches, *[[a] * len(batches) for a in args])
+                windows = [w for batch in results for w in batch]
+        else:
+            windows = [w for batch in batches for w in _split_page_batch(batch, *args)]
 
-            p_idx = len(parents)
+        for ((book, page), parent_text), chunks in zip(pages, windows):
+            p_id = parent_id_of(book, page, "parent", parent_text)
             parents.append(
                 Document(
                     page_content=parent_text,
-                    metadata={"type": "parent", "book_idx": book, "page_idx": page}
+                    metadata={"type": "parent", "book_idx": book, "page_idx": page,
+                              "parent_id": p_id}
                 )
             )
 
-            for ch in splitter.split_text(parent_text):
+            for seq, (ch, n_tokens) in enumerate(chunks):
                 children.append(
                     Document(
                         page_content=ch,
@@ -78,12 +204,52 @@ class TextSplitter():
                             "type":      "child",
                             "book_idx":  book,
                             "page_idx":  page,
-                            "parent_id": p_idx,
-                            "chunk_id":  chunk_id,
-                            "length_tokens": self.count_tokens(ch)
+                            "parent_id": p_id,
+                            "chunk_id":  stable_id(p_id, seq, ch),
+                            "length_tokens": n_tokens
                         }
                     )
                 )
-                chunk_id += 1
 
-        return parents, children
\ No newline at end of file
+        return parents, children
+
+
+    def split_docs_cached(self, docs, CHUNK_PATH, **split_kwargs):
+        """
+        切块结果与 docs 指纹一起持久化在 CHUNK_PATH；docs 与切块参数未变时直接 mmap 读取，
+        否则重新切块并写回。workers 等不影响输出的参数不计入指纹
+        """
+        params = {k: v for k, v in split_kwargs.items() if k not in {"workers", "batch_pages"}}
+        fp = docs_fingerprint(docs, **params)
+        cached = load_chunks(CHUNK_PATH, fp)
+        if cached is not None:
+            print(f"Loaded persisted chunks from {CHUNK_PATH}")
+            return cached
+        parents, children = self.split_docs(docs, **split_kwargs)
+        save_chunks(parents, children, CHUNK_PATH, fp)
+        return load_chunks(CHUNK_PATH)
+
+
+    def split_delta(
+        self,
+        parents: List[Document],
+        children: List[Document],
+        new_docs: List[Document],
+        stale_books,
+        chunk_size: int = 300,
+        chunk_overlap: int = 50,
+        **split_kwargs
+    ) -> Tuple[List[Document], List[Document], List[Document], List[Document]]:
+        """
+        增量切块：去掉 stale_books 的父/子块，只对 new_docs 重新切块后追加
+        返回 (parents, children, added_children, removed_children)；
+        parent_id / chunk_id 由内容派生，保留部分无需重新编号
+        """
+        stale_books = set(stale_books)
+        kept_parents  = [p for p in parents  if p.metadata["book_idx"] not in stale_books]
+        kept_children = [c for c in children if c.metadata["book_idx"] not in stale_books]
+        removed_children = [c for c in children if c.metadata["book_idx"] in stale_books]
+
+        new_parents, added_children = self.split_docs(new_docs, chunk_size, chunk_overlap, **split_kwargs)
+        return (kept_parents + new_parents, kept_children + added_children,
+                added_children, removed_children)
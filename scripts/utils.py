@@ -2,12 +2,14 @@
 Merge every *.json file under /data/huali_data/  (each is a list of instances)
 into one big JSON list and save to /data/huali_mm/huali_corpus.json
 """
-import json, os
+import json
 from tqdm import tqdm
 from pathlib import Path
+from typing import List, Optional
 from itertools import islice
 from collections import Counter, defaultdict
 from langchain.docstore.document import Document
+from .doc_store import DocStore, write_doc_store
 from IPython.display import display, Markdown, Image
 
 
@@ -18,41 +20,132 @@ from IPython.display import display, Markdown, Image
 
 
 
-def merge_corpus(CORPUS_PATH, OUTPUT_FILE):
-    all_instances = []
-
-    json_files = sorted(CORPUS_PATH.rglob("*.json"))  
-    for book_idx, json_file in enumerate(json_files):
-        with open(json_file, "r", encoding="utf-8") as f:
+def _is_number(x) -> bool:
+    return isinstance(x, (int, float)) and not isinstance(x, bool)
+
+
+def iter_json_array(path, chunk_size: int = 1 << 20):
+    """
+    流式解析顶层为 list 的 JSON 文件，逐个 yield 元素，
+    内存占用只与单个元素大小有关，而不是整个文件
+    """
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as f:
+        buf, pos, eof = "", 0, False
+
+        def fill():
+            nonlocal buf, pos, eof
+            chunk = f.read(chunk_size)
+            if not chunk:
+                eof = True
+            buf, pos = buf[pos:] + chunk, 0
+
+        def skip_ws():
+            nonlocal pos
+            while True:
+                while pos < len(buf) and buf[pos].isspace():
+                    pos += 1
+                if pos < len(buf) or eof:
+                    return
+                fill()
+
+        skip_ws()
+        if pos >= len(buf) or buf[pos] != "[":
+            raise ValueError(f"{path} 顶层不是 JSON 列表")
+        pos += 1
+        skip_ws()
+        if pos < len(buf) and buf[pos] == "]":
+            return
+
+        while True:
+            skip_ws()
             try:
-                items = json.load(f)          
-                if isinstance(items, list):
-                    for inst in items:
-                        inst["book_idx"] = book_idx
-                    all_instances.extend(items)
-                else:
-                    print(f"[Warn] {json_file} 不是列表，已跳过")
-            except json.JSONDecodeError as e:
-                print(f"[Error] {json_file} 解析失败: {e}")
+                item, end = decoder.raw_decode(buf, pos)
+                # 数字可能被 chunk 边界截断（"12|3"、"1.|5"、"1e|-3"），
+                # 其后若只剩数字字符且未到 EOF，须读入更多数据再判
+                if not eof and (end == len(buf) or _is_number(item)
+                                and buf[end:].strip("0123456789.eE+-") == ""):
+                    raise json.JSONDecodeError("truncated", buf, end)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                fill()
+                continue
+            yield item
+            pos = end
+            skip_ws()
+            if pos >= len(buf):
+                raise json.JSONDecodeError("unexpected end of file", buf, pos)
+            if buf[pos] == ",":
+                pos += 1
+            elif buf[pos] == "]":
+                return
+            else:
+                raise json.JSONDecodeError("expected ',' or ']'", buf, pos)
+
+
+def list_book_files(CORPUS_PATH) -> List[Path]:
+    """CORPUS_PATH 下的每本书对应一个 *.json，book_idx 即排序后的下标"""
+    return sorted(Path(CORPUS_PATH).rglob("*.json"))
+
+
+def iter_book_insts(json_file, book_idx: int, failed_books: Optional[set] = None):
+    """
+    读取单本书的解析结果，并打上 book_idx。
+    先完整解析整本书再逐条产出：中途损坏的书整本跳过，不会只进入前半部分
+    （内存占用为单本书而非整个语料）；failed_books 若给定，解析失败的 book_idx 加入其中
+    """
+    try:
+        insts = list(iter_json_array(json_file))
+    except ValueError as e:          # 含 JSONDecodeError
+        print(f"[Error] {json_file} 解析失败，整本跳过: {e}")
+        if failed_books is not None:
+            failed_books.add(book_idx)
+        return
+    for inst in insts:
+        inst["book_idx"] = book_idx
+        yield inst
+
+
+def iter_corpus(CORPUS_PATH):
+    """不经过合并文件，直接从 CORPUS_PATH 下的逐书 JSON 流式产出 inst"""
+    for book_idx, json_file in enumerate(list_book_files(CORPUS_PATH)):
+        yield from iter_book_insts(json_file, book_idx)
+
+
+def iter_kb(KB_PATH):
+    """
+    KB_PATH 为目录 → 逐书流式读取（同 merge_corpus 的 book_idx 规则）
+    KB_PATH 为文件 → 流式读取合并后的 JSON 列表
+    """
+    if Path(KB_PATH).is_dir():
+        return iter_corpus(KB_PATH)
+    return iter_json_array(KB_PATH)
 
-    print(f"Total merged instances: {len(all_instances)}")
 
-    with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
-        json.dump(all_instances, f, ensure_ascii=False, indent=2)
 
+def merge_corpus(CORPUS_PATH, OUTPUT_FILE):
+    """逐书流式读取并逐条写出，不在内存中拼接整个语料"""
+    n_total = 0
+    with open(OUTPUT_FILE, "w", encoding="utf-8") as out:
+        out.write("[")
+        for inst in iter_corpus(CORPUS_PATH):
+            out.write(",\n" if n_total else "\n")
+            out.write(json.dumps(inst, ensure_ascii=False))
+            n_total += 1
+        out.write("\n]\n")
+
+    print(f"Total merged instances: {n_total}")
     print(f"✅ Saved to {OUTPUT_FILE}")
     
 
 
 def analyze_kb_types(kb_path):
-    with open(kb_path, encoding="utf-8") as f:
-        all_insts = json.load(f)
-
     type_counter = Counter()
     missing_img_path_idxs = []
     samples = defaultdict(list)
 
-    for idx, inst in enumerate(tqdm(all_insts, desc="Analyzing KB instances")):
+    for idx, inst in enumerate(tqdm(iter_kb(kb_path), desc="Analyzing KB instances")):
         t = inst.get("type")
         type_counter[t] += 1
 
@@ -91,18 +184,30 @@ def union_docs(docs):
 
 
 def save_docs(docs, OUTPUT_DOCS= Path("/data/huali_mm/docs.json")):
-    serializable = [
-        {"page_content": doc.page_content, "metadata": doc.metadata}
-        for doc in docs
-    ]
-    with open(OUTPUT_DOCS, "w", encoding="utf-8") as f:
-        json.dump(serializable, f, ensure_ascii=False, indent=2)
+    """
+    OUTPUT_DOCS 以 .json 结尾 → 写 JSON（兼容旧格式）；
+    否则视为目录 → 写 mmap 二进制 DocStore
+    """
+    if str(OUTPUT_DOCS).endswith(".json"):
+        serializable = [
+            {"page_content": doc.page_content, "metadata": doc.metadata}
+            for doc in docs
+        ]
+        with open(OUTPUT_DOCS, "w", encoding="utf-8") as f:
+            json.dump(serializable, f, ensure_ascii=False, indent=2)
+        n = len(serializable)
+    else:
+        n = write_doc_store(docs, OUTPUT_DOCS)
 
-    print(f"✅ Saved {len(docs)} docs to {OUTPUT_DOCS}")
+    print(f"✅ Saved {n} docs to {OUTPUT_DOCS}")
 
 
 
 def load_serialized_docs(path: Path):
+    """目录 → DocStore（mmap，按需构造 Document）；JSON 文件 → List[Document]"""
+    if Path(path).is_dir():
+        return DocStore(path)
+
     with open(path, encoding="utf-8") as f:
         raw_items = json.load(f)         # list[dict]
 
@@ -115,6 +220,23 @@ def load_serialized_docs(path: Path):
     return docs
 
 
+def docs_json_to_store(json_path, store_path) -> int:
+    """把已有的 docs.json 流式转换为 DocStore"""
+    docs = (Document(page_content=item["page_content"], metadata=item["metadata"])
+            for item in iter_json_array(json_path))
+    n = write_doc_store(docs, store_path)
+    print(f"✅ Converted {n} docs: {json_path} → {store_path}")
+    return n
+
+
+def docs_store_to_json(store_path, json_path) -> int:
+    """DocStore → docs.json（与 save_docs 的 JSON 格式一致）"""
+    store = DocStore(store_path)
+    save_docs(store, json_path)
+    return len(store)
+
+
+
 def preview_docs_by_type(docs, n_preview=5):
     """按 metadata['type'] 分组打印前 n_preview 个 Document"""
     buckets = defaultdict(list)
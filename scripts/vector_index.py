@@ -0,0 +1,305 @@
+"""
+FAISS 向量库的 manifest 与增量同步：
+  <INDEX_PATH>/manifest.json = {"model": 稠密模型, "chunks": {chunk_id: 内容哈希}}
+加载时与当前 children 对比，只为新增 / 内容变化的子块做 embedding，删除已不存在的子块；
+稠密模型变化（或旧索引没有 manifest）时才全量重建
+
+INDEX_TYPE 为 flat 以外的 ANN 索引（ivf / hnsw / ivfpq / sq / ivfsq）时：
+由子块向量（经 embedding 缓存复用）训练并构建，以 mmap 只读方式打开；
+子块有增删时整体重建，manifest 额外记录索引的 factory 串
+"""
+import os, json, time, pickle
+import numpy as np
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
+from langchain.docstore.document import Document
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from .cache import sha256_text
+
+
+
+MANIFEST_FILE = "manifest.json"
+INDEX_TYPES   = {"flat", "ivf", "hnsw", "ivfpq", "sq", "ivfsq"}
+
+
+def index_config(configs: dict) -> dict:
+    """从 configs 取出索引相关参数（未给出的取默认值）"""
+    cfg = {
+        "type":            configs.get("INDEX_TYPE", "flat"),
+        "factory":         configs.get("INDEX_FACTORY"),        # 直接给 faiss.index_factory 串时优先使用
+        "nlist":           configs.get("IVF_NLIST"),            # 默认 4·sqrt(N)
+        "nprobe":          configs.get("IVF_NPROBE", 16),
+        "hnsw_m":          configs.get("HNSW_M", 32),
+        "ef_search":       configs.get("HNSW_EF_SEARCH", 64),
+        "ef_construction": configs.get("HNSW_EF_CONSTRUCTION", 80),
+        "pq_m":            configs.get("PQ_M"),                 # 默认 dim/4（需整除 dim）
+        "pq_nbits":        configs.get("PQ_NBITS", 8),
+        "sq":              configs.get("SQ_TYPE", "SQ8"),
+        "train_size":      configs.get("INDEX_TRAIN_SIZE", 100_000),
+    }
+    if cfg["type"] not in INDEX_TYPES and not cfg["factory"]:
+        raise ValueError(f"未知索引类型: {cfg['type']!r}（可选 {sorted(INDEX_TYPES)}）")
+    return cfg
+
+
+def factory_spec(cfg: dict, dim: int, n: int) -> str:
+    """索引参数 → faiss.index_factory 串；它同时作为索引结构的标识写入 manifest"""
+    if cfg.get("factory"):
+        return cfg["factory"]
+    typ = cfg["type"]
+    # 每个聚类中心至少约 39 个训练点，小语料时自动收缩 nlist
+    nlist = cfg["nlist"] or int(4 * np.sqrt(max(n, 1)))
+    nlist = max(1, min(nlist, n // 39 or 1))
+    pq_m  = cfg["pq_m"] or max(1, dim // 4)
+    if typ == "flat":
+        return "Flat"
+    if typ == "ivf":
+        return f"IVF{nlist},Flat"
+    if typ == "hnsw":
+        return f"HNSW{cfg['hnsw_m']}"
+    if typ == "ivfpq":
+        if dim % pq_m:
+            raise ValueError(f"PQ_M={pq_m} 不能整除向量维度 {dim}")
+        return f"IVF{nlist},PQ{pq_m}x{cfg['pq_nbits']}"
+    if typ == "sq":
+        return cfg["sq"]
+    return f"IVF{nlist},{cfg['sq']}"
+
+
+def load_index_manifest(index_dir) -> dict:
+    path = Path(index_dir) / MANIFEST_FILE
+    if not path.exists():
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_index_manifest(manifest: dict, index_dir) -> None:
+    path = Path(index_dir) / MANIFEST_FILE
+    tmp  = path.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def chunk_manifest(children: Sequence[Document]) -> dict:
+    return {str(c.metadata["chunk_id"]): sha256_text(c.page_content)[:16] for c in children}
+
+
+def diff_manifest(stored: dict, children: Sequence[Document]) -> Tuple[List[Document], List[str]]:
+    """返回 (需要 embedding 插入的子块, 需要删除的 chunk_id)"""
+    current = chunk_manifest(children)
+    to_delete = [cid for cid, h in stored.items() if current.get(cid) != h]
+    to_add    = [c for c in children
+                 if stored.get(str(c.metadata["chunk_id"])) != current[str(c.metadata["chunk_id"])]]
+    return to_add, to_delete
+
+
+
+def sync_vector_index(vectordb: FAISS, manifest: dict, children: Sequence[Document]) -> Tuple[int, int]:
+    """把 vectordb 增量同步到 children，原地更新 manifest["chunks"]，返回 (新增数, 删除数)"""
+    to_add, to_delete = diff_manifest(manifest.get("chunks", {}), children)
+    present = set(vectordb.index_to_docstore_id.values())
+    to_delete = [cid for cid in to_delete if cid in present]
+    if to_delete:
+        vectordb.delete(to_delete)
+    if to_add:
+        vectordb.add_documents(list(to_add), ids=[str(c.metadata["chunk_id"]) for c in to_add])
+    manifest["chunks"] = chunk_manifest(children)
+    return len(to_add), len(to_delete)
+
+
+
+def set_search_params(index, cfg: dict) -> None:
+    """nprobe / efSearch 只影响查询，不进 manifest，改 configs 即可生效无需重建"""
+    import faiss
+    ps = faiss.ParameterSpace()
+    if "IVF" in type(index).__name__:
+        ps.set_index_parameter(index, "nprobe", int(cfg["nprobe"]))
+    if "HNSW" in type(index).__name__:
+        ps.set_index_parameter(index, "efSearch", int(cfg["ef_search"]))
+
+
+def build_ann_index(vectors: np.ndarray, spec: str, cfg: dict, seed: int = 0):
+    """按 factory 串建索引：需要训练时从向量中无放回采样至多 train_size 条训练，再分批加入"""
+    import faiss
+    n, dim = vectors.shape
+    index = faiss.index_factory(dim, spec)
+    if not index.is_trained:
+        sample = vectors
+        if n > cfg["train_size"]:
+            rng = np.random.default_rng(seed)
+            sample = vectors[np.sort(rng.choice(n, cfg["train_size"], replace=False))]
+        index.train(sample)
+    if hasattr(index, "hnsw"):
+        index.hnsw.efConstruction = int(cfg["ef_construction"])
+    for i in range(0, n, 65536):
+        index.add(vectors[i:i + 65536])
+    return index
+
+
+def _build_ann_store(children: Sequence[Document], embeddings, index_dir: Path,
+                     model_name: str, cfg: dict) -> FAISS:
+    """ANN 索引全量构建：向量由 embeddings 给出（命中 embedding 缓存时不再前向计算）"""
+    children = list(children)
+    vectors  = np.asarray(embeddings.embed_documents([c.page_content for c in children]), dtype=np.float32)
+    spec     = factory_spec(cfg, vectors.shape[1], len(children))
+    t0 = time.perf_counter()
+    index = build_ann_index(vectors, spec, cfg)
+    print(f"Built FAISS {spec} over {len(children)} chunks in {time.perf_counter() - t0:.1f}s")
+
+    ids = [str(c.metadata["chunk_id"]) for c in children]
+    docstore = InMemoryDocstore({i: Document(page_content=c.page_content, metadata=dict(c.metadata))
+                                 for i, c in zip(ids, children)})
+    vectordb = FAISS(embeddings, index, docstore, dict(enumerate(ids)))
+    save_store(vectordb, index_dir)
+    save_index_manifest({"model": model_name, "index": spec, "dim": int(vectors.shape[1]), "chunks": chunk_manifest(children)}, index_dir)
+    # 重新以 mmap 方式打开，常驻内存只剩 docstore
+    return load_mmap_index(index_dir, embeddings, cfg)
+
+
+def save_store(vectordb: FAISS, index_dir) -> None:
+    """
+    与 FAISS.save_local 写出相同的 index.faiss / index.pkl，但各自先写 .tmp 再 os.replace：
+    仍以 IO_FLAG_MMAP 映射着旧 index.faiss 的读者不受影响，中途崩溃也不会留下写了一半的文件
+    """
+    import faiss
+    index_dir = Path(index_dir)
+    index_dir.mkdir(parents=True, exist_ok=True)
+    tmp = index_dir / "index.faiss.tmp"
+    faiss.write_index(vectordb.index, str(tmp))
+    os.replace(tmp, index_dir / "index.faiss")
+    tmp = index_dir / "index.pkl.tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump((vectordb.docstore, vectordb.index_to_docstore_id), f)
+    os.replace(tmp, index_dir / "index.pkl")
+
+
+def load_mmap_index(index_dir, embeddings, cfg: dict) -> FAISS:
+    """以 IO_FLAG_MMAP 只读打开 index.faiss，多个进程共享同一份页缓存"""
+    import faiss
+    index_dir = Path(index_dir)
+    index = faiss.read_index(str(index_dir / "index.faiss"), faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    set_search_params(index, cfg)
+    with open(index_dir / "index.pkl", "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)     # 本项目写出的文件
+    return FAISS(embeddings, index, docstore, index_to_docstore_id)
+
+
+
+def open_vector_index(children: Sequence[Document], embeddings, index_dir, model_name: str,
+                      cfg: Optional[dict] = None) -> FAISS:
+    """
+    读取 / 增量同步 / 全量重建 FAISS 索引，返回与 children 一致的 vectordb
+    """
+    cfg = cfg or index_config({})
+    index_dir = Path(index_dir)
+    manifest  = load_index_manifest(index_dir)
+    if cfg["type"] != "flat" or cfg["factory"]:
+        return _open_ann_index(children, embeddings, index_dir, model_name, cfg, manifest)
+
+    exists = (index_dir / "index.faiss").exists()
+    if exists and manifest.get("model") == model_name and manifest.get("index", "Flat") == "Flat":
+        # 索引由本项目写出，可信任其 pickle docstore
+        vectordb = FAISS.load_local(str(index_dir), embeddings, allow_dangerous_deserialization=True)
+        n_add, n_del = sync_vector_index(vectordb, manifest, children)
+        if n_add or n_del:
+            save_store(vectordb, index_dir)
+            save_index_manifest(manifest, index_dir)
+        print(f"Loaded FAISS index from {index_dir} (+{n_add} / -{n_del} chunks synced)")
+        return vectordb
+
+    if exists:
+        print(f"[Warn] FAISS index at {index_dir} was built as {manifest.get('index', 'Flat')} with "
+              f"{manifest.get('model', 'an unknown model')}, rebuilding as Flat for {model_name}")
+    # 以稳定的 chunk_id 作为向量库中的文档 id，便于复用与增量 add / delete
+    vectordb = FAISS.from_documents(list(children), embeddings,
+                                    ids=[str(c.metadata["chunk_id"]) for c in children])
+    save_store(vectordb, index_dir)
+    save_index_manifest({"model": model_name, "index": "Flat", "chunks": chunk_manifest(children)}, index_dir)
+    return vectordb
+
+
+def _open_ann_index(children, embeddings, index_dir: Path, model_name: str, cfg: dict,
+                    manifest: dict) -> FAISS:
+    if (index_dir / "index.faiss").exists() and manifest.get("model") == model_name:
+        to_add, to_delete = diff_manifest(manifest.get("chunks", {}), children)
+        spec = factory_spec(cfg, manifest.get("dim", 0), len(children))
+        if manifest.get("index") == spec and not to_add and not to_delete:
+            print(f"Loaded FAISS {spec} index from {index_dir} (mmap)")
+            return load_mmap_index(index_dir, embeddings, cfg)
+        print(f"FAISS index at {index_dir} is stale ({manifest.get('index')} → {spec}, "
+              f"+{len(to_add)} / -{len(to_delete)} chunks), rebuilding")
+    return _build_ann_store(children, embeddings, index_dir, model_name, cfg)
+
+
+def update_vector_index(vectordb: FAISS, children: Sequence[Document], embeddings, index_dir,
+                        model_name: str, cfg: Optional[dict] = None) -> Tuple[FAISS, int, int]:
+    """
+    把已打开的 vectordb 同步到新的 children，返回 (vectordb, 新增数, 删除数)
+    Flat 索引原地 add / delete；mmap 的 ANN 索引只读，由 embedding 缓存中的向量重建
+    """
+    cfg = cfg or index_config({})
+    index_dir = Path(index_dir)
+    manifest  = load_index_manifest(index_dir)
+    if cfg["type"] == "flat" and not cfg["factory"]:
+        n_add, n_del = sync_vector_index(vectordb, manifest, children)
+        save_store(vectordb, index_dir)
+        save_index_manifest(manifest, index_dir)
+        return vectordb, n_add, n_del
+    to_add, to_delete = diff_manifest(manifest.get("chunks", {}), children)
+    if to_add or to_delete:
+        vectordb = _build_ann_store(children, embeddings, index_dir, model_name, cfg)
+    return vectordb, len(to_add), len(to_delete)
+
+
+
+def _selector_params(index, ids: np.ndarray):
+    """只在 ids 内检索的 SearchParameters，沿用索引当前的 nprobe / efSearch"""
+    import faiss
+    sel = faiss.IDSelectorBatch(np.asarray(ids, dtype=np.int64))
+    name = type(index).__name__
+    if "IVF" in name:
+        params = faiss.SearchParametersIVF(sel=sel, nprobe=faiss.extract_index_ivf(index).nprobe)
+    elif "HNSW" in name:
+        params = faiss.SearchParametersHNSW(sel=sel, efSearch=index.hnsw.efSearch)
+    else:
+        params = faiss.SearchParameters(sel=sel)
+    return params, sel
+
+
+def ann_recall(vectordb: FAISS, embeddings, queries: Sequence[str], k: int = 10,
+               sample_size: Optional[int] = None, seed: int = 0) -> dict:
+    """
+    以精确 Flat 检索为基准，报告 ANN 索引的 recall@k 与每查询耗时（毫秒）。基准向量：
+      · 默认由 index.reconstruct_n 从索引本身取回，不重新 embedding 语料（Flat / IVF-Flat / HNSW 无损；
+        PQ / SQ 取回的是量化后的向量，此时 recall 只反映聚类 / 图检索的损失）
+      · 给定 sample_size（小于索引条数）时随机抽取 sample_size 个子块重新 embedding 作基准，
+        ANN 检索经 IDSelector 限定在样本内：计入量化误差，开销与样本大小而非语料大小成正比
+    """
+    import faiss
+    index = vectordb.index
+    n = index.ntotal
+    if sample_size is not None and sample_size < n:
+        ids   = np.sort(np.random.default_rng(seed).choice(n, sample_size, replace=False))
+        texts = [vectordb.docstore.search(vectordb.index_to_docstore_id[int(i)]).page_content for i in ids]
+        base  = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+        params, _sel = _selector_params(index, ids)       # _sel 须在检索期间保持存活
+    else:
+        ids, params = None, None
+        base = index.reconstruct_n(0, n)
+    exact = faiss.IndexFlatL2(base.shape[1])
+    exact.add(base)
+    Q = np.asarray([embeddings.embed_query(q) for q in queries], dtype=np.float32)
+    k = min(k, len(base))
+
+    t0 = time.perf_counter(); _, I_ann = index.search(Q, k, params=params); t_ann = time.perf_counter() - t0
+    t0 = time.perf_counter(); _, I_ex  = exact.search(Q, k);                t_ex  = time.perf_counter() - t0
+    if ids is not None:
+        I_ex = ids[I_ex]
+    hits = sum(len(set(a[a >= 0].tolist()) & set(e.tolist())) for a, e in zip(I_ann, I_ex))
+    return {"k": k, "queries": len(queries), "recall": hits / (k * len(queries)) if len(queries) else 0.0,
+            "ann_ms": 1000 * t_ann / max(len(queries), 1), "exact_ms": 1000 * t_ex / max(len(queries), 1),
+            "index": type(index).__name__, "base": "sample" if ids is not None else "reconstruct",
+            "base_size": len(base)}
@@ -9,8 +9,8 @@ setup(
     packages=find_packages(),
     python_requires='>=3.9',
     install_requires=[
-        "rank_bm25",
         "numpy==1.26.4",
+        "tqdm>=4.64.0",
         "scipy==1.11.4",
         "scikit-learn==1.4.2",
         "faiss-gpu",
@@ -0,0 +1,157 @@
+"""
+QwenClient 对本地 stub HTTP endpoint 的测试：重试 / 退避、token bucket 限速、并发上限
+stub 按 DashScope multimodal-generation 的响应格式返回，请求经真实的 MultiModalConversation 发出
+"""
+import json, time, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from scripts.qwen_client import QwenClient, QwenAPIError, TokenBucket
+
+
+MESSAGES = [{"role": "user", "content": [{"text": "ping"}]}]
+
+
+class StubServer():
+    """
+    statuses: 依次返回的 HTTP 状态码，用完后一律 200
+    delay   : 每个请求的处理耗时（秒），用于观察在途并发数
+    """
+    def __init__(self, statuses=(), delay=0.0):
+        self.statuses = list(statuses)
+        self.delay    = delay
+        self.hits     = 0
+        self.inflight = 0
+        self.max_inflight = 0
+        self.lock = threading.Lock()
+
+        stub = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                with stub.lock:
+                    stub.hits += 1
+                    stub.inflight += 1
+                    stub.max_inflight = max(stub.max_inflight, stub.inflight)
+                    status = stub.statuses.pop(0) if stub.statuses else 200
+                time.sleep(stub.delay)
+                if status == 200:
+                    body = {"request_id": "stub",
+                            "output": {"choices": [{"finish_reason": "stop",
+                                                    "message": {"role": "assistant", "content": [{"text": "pong"}]}}]},
+                            "usage": {"input_tokens": 3, "output_tokens": 1}}
+                else:
+                    code = "Throttling.RateQuota" if status == 429 else "InvalidParameter"
+                    body = {"request_id": "stub", "code": code, "message": f"stub {status}"}
+                out = json.dumps(body).encode()
+                with stub.lock:
+                    stub.inflight -= 1
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url   = f"http://127.0.0.1:{self.httpd.server_port}/api/v1"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def stub():
+    servers = []
+    def make(**kwargs):
+        servers.append(StubServer(**kwargs))
+        return servers[-1]
+    yield make
+    for s in servers:
+        s.close()
+
+
+def make_client(url, **kwargs):
+    kwargs.setdefault("default_rate", 1000.0)
+    kwargs.setdefault("backoff_base", 0.01)
+    return QwenClient(api_key="stub", base_url=url, **kwargs)
+
+
+
+# ---------- 重试 / 退避 ----------
+def test_retries_throttled_requests_then_succeeds(stub):
+    server = stub(statuses=[429, 503])
+    client = make_client(server.url)
+    assert client.call_text("qwen-stub", MESSAGES) == "pong"
+    assert server.hits == 3
+    m = client.metrics()["qwen-stub"]
+    assert (m["calls"], m["errors"], m["retries"], m["throttled"]) == (3, 2, 2, 2)
+    assert (m["input_tokens"], m["output_tokens"]) == (3, 1)
+
+
+def test_non_retryable_error_is_raised_immediately(stub):
+    server = stub(statuses=[400])
+    client = make_client(server.url)
+    with pytest.raises(QwenAPIError) as exc:
+        client.call("qwen-stub", MESSAGES)
+    assert not exc.value.retryable
+    assert server.hits == 1
+
+
+def test_gives_up_after_max_retries(stub):
+    server = stub(statuses=[429] * 10)
+    client = make_client(server.url, max_retries=2)
+    with pytest.raises(QwenAPIError) as exc:
+        client.call("qwen-stub", MESSAGES)
+    assert exc.value.retryable
+    assert server.hits == 3
+
+
+def test_backoff_is_full_jitter_within_cap():
+    client = QwenClient(api_key="stub", backoff_base=0.5, backoff_max=3.0)
+    for attempt in range(6):
+        cap = min(3.0, 0.5 * 2 ** attempt)
+        assert all(0.0 <= client._backoff(attempt) <= cap for _ in range(200))
+
+
+
+# ---------- token bucket ----------
+def test_token_bucket_refills_at_rate():
+    bucket = TokenBucket(rate=20.0, capacity=2)
+    t0 = time.monotonic()
+    for _ in range(6):              # 2 个来自初始容量，其余 4 个按 20/s 补充
+        bucket.acquire()
+    assert 0.18 <= time.monotonic() - t0 < 1.0
+
+
+def test_client_rate_limit_is_per_model(stub):
+    server = stub()
+    client = make_client(server.url, rate_limits={"slow": 10.0}, burst=1)
+    t0 = time.monotonic()
+    for _ in range(4):
+        client.call("slow", MESSAGES)
+    slow = time.monotonic() - t0
+
+    t0 = time.monotonic()
+    for _ in range(4):
+        client.call("fast", MESSAGES)
+    fast = time.monotonic() - t0
+    assert slow >= 0.28
+    assert fast < slow
+
+
+
+# ---------- 并发上限 ----------
+def test_semaphore_caps_inflight_requests(stub):
+    server = stub(delay=0.1)
+    client = make_client(server.url, max_concurrency=2)
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        texts = list(ex.map(lambda _: client.call_text("qwen-stub", MESSAGES), range(8)))
+    assert texts == ["pong"] * 8
+    assert server.max_inflight == 2
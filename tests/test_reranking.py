@@ -0,0 +1,25 @@
+"""
+parse_block_scores 对 LLM 输出的容错：代码块包裹、宽松 JSON、JSON 之后还有带括号的说明文字
+"""
+from scripts.reranking import parse_block_scores
+
+
+def test_parse_scores_object():
+    assert parse_block_scores('{"scores": [0.9, 0.1, 0.5]}', 3) == [0.9, 0.1, 0.5]
+
+
+def test_parse_scores_code_fence_and_json5():
+    txt = "结果如下：\n```json\n{scores: [0.8, 0.2,],}\n```"
+    assert parse_block_scores(txt, 2) == [0.8, 0.2]
+
+
+def test_parse_scores_trailing_text():
+    txt = '[0.7, 0.3]\n说明：块 [1] 与问题最相关，块 [2] 只提到 {部分} 信息。'
+    assert parse_block_scores(txt, 2) == [0.7, 0.3]
+    txt = '{"scores": [0.6, 0.4]} (scores are in [0, 1])'
+    assert parse_block_scores(txt, 2) == [0.6, 0.4]
+
+
+def test_parse_scores_index_keys_and_invalid():
+    assert parse_block_scores('{"1": 0.5, "3": 2.0}', 3) == [0.5, None, None]
+    assert parse_block_scores("无法评分", 2) == [None, None]
@@ -0,0 +1,32 @@
+"""
+iter_json_array 的流式解析测试：元素（尤其是数字/字面量）跨 chunk 边界时结果须与 json.load 一致
+"""
+import json
+
+import pytest
+from scripts.utils import iter_json_array
+
+
+DATA = [123, -4.5e-3, 1e10, 0, 7.25, True, None, "a,b]", {"k": [1, 22, 333]}, [], 98765]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 7, 1 << 20])
+def test_iter_json_array_chunk_boundaries(tmp_path, chunk_size):
+    path = tmp_path / "arr.json"
+    for text in (json.dumps(DATA), json.dumps(DATA, indent=2)):
+        path.write_text(text, encoding="utf-8")
+        assert list(iter_json_array(path, chunk_size=chunk_size)) == DATA
+
+
+def test_iter_json_array_trailing_number(tmp_path):
+    path = tmp_path / "arr.json"
+    path.write_text("[1, 2, 345678]", encoding="utf-8")
+    for chunk_size in range(1, 16):
+        assert list(iter_json_array(path, chunk_size=chunk_size)) == [1, 2, 345678]
+
+
+def test_iter_json_array_truncated_file(tmp_path):
+    path = tmp_path / "arr.json"
+    path.write_text("[1, 2, 3", encoding="utf-8")
+    with pytest.raises(json.JSONDecodeError):
+        list(iter_json_array(path, chunk_size=2))